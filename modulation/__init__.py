@@ -244,6 +244,24 @@ class Plugin(threading.Thread):
             self._q.put(pkt)
             self._log.debug("Accepted packet %r", pkt)
 
+    def _takeQueued(self, match):
+        """Removes the packets waiting in this plugin's queue for which match(pkt) is true, and returns them
+
+        Packets behind a KillPacket are left alone.
+        """
+        taken = []
+        with self._q.mutex:
+            for pkt in self._q.queue:
+                if (isinstance(pkt, KillPacket)):
+                    break
+                if (isinstance(pkt, Packet) and match(pkt)):
+                    taken.append(pkt)
+            for pkt in taken:
+                self._q.queue.remove(pkt)
+        for pkt in taken:
+            self._q.task_done()
+        return taken
+
     def kill(self):
         """Asks this plugin to terminate"""
         self.acceptPacket(KillPacket(self))
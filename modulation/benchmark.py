@@ -0,0 +1,628 @@
+# -*- coding: utf-8 -*-
+# Copyright 2010 Trever Fischer <tdfischer@fedoraproject.org>
+#
+# This file is part of modulation.
+#
+# modulation is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# modulation is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with modulation. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for collection scanning and querying against synthetic libraries
+
+Run with:
+    python -m modulation.benchmark scan <directory> [files]
+    python -m modulation.benchmark queries <database> [entries] [queries] [shards]
+    python -m modulation.benchmark memory [files]
+    python -m modulation.benchmark lazy <directory> [files] [budgetMB]
+    python -m modulation.benchmark snapshot <file> [entries]
+    python -m modulation.benchmark suite <directory> <results.json> [files...]
+    python -m modulation.benchmark compare <baseline.json> <results.json> [tolerance]
+
+The suite builds a synthetic tree of empty files for each size under
+directory, reading made up tags instead of taglib, and writes what it
+measured to a JSON file. compare reports every measurement in one results
+file that is worse than in another by more than tolerance, 0.2 (20%) by
+default, and fails if there are any.
+"""
+
+import json
+import modulation
+import modulation.collection
+import modulation.indexer
+import modulation.media
+import modulation.query
+import modulation.snapshot
+import os
+import platform
+import random
+import re
+import resource
+import sys
+import threading
+import time
+from Queue import Queue
+
+def makeTree(path, files, perDirectory=100):
+    """Creates a synthetic artist/album/track tree of empty files under path"""
+    for i in xrange(files):
+        album = i // perDirectory
+        directory = "%s/artist%04i/album%02i"%(path, album // 100, album % 100)
+        if (i % perDirectory == 0 and not os.path.isdir(directory)):
+            os.makedirs(directory)
+        track = "%s/track%03i.ogg"%(directory, i % perDirectory)
+        if (not os.path.exists(track)):
+            open(track, "w").close()
+
+def countLeaves(node):
+    """Returns the number of leaves beneath node"""
+    ret = 0
+    stack = [node]
+    while (len(stack) > 0):
+        for child in stack.pop().contents:
+            if (isinstance(child, modulation.collection.Node)):
+                stack.append(child)
+            else:
+                ret += 1
+    return ret
+
+def benchDirectoryScan(path):
+    """Times building a DirectoryRoot over path, then a rescan of it"""
+    start = time.time()
+    root = modulation.collection.DirectoryRoot(path)
+    build = time.time() - start
+    start = time.time()
+    root.update()
+    rescan = time.time() - start
+    count = countLeaves(root)
+    print "DirectoryRoot: %i files, build %.2fs (%.0f files/s), rescan %.2fs (%.0f files/s)"%(
+        count, build, count/max(build, 1e-9), rescan, count/max(rescan, 1e-9))
+    return root
+
+def maxRSS():
+    """Returns the peak resident set size of this process, in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def makeDirectoryTree(files, perDirectory=100):
+    """Builds the tree makeTree() lays out on disk in memory, without touching the disk"""
+    root = modulation.collection.Directory('')
+    artist = None
+    for i in xrange(files):
+        album = i // perDirectory
+        if (i % perDirectory == 0):
+            if (album % 100 == 0):
+                artist = modulation.collection.Directory("artist%04i"%(album // 100), root)
+                root.addChild(artist)
+            directory = modulation.collection.Directory("album%02i"%(album % 100), artist)
+            artist.addChild(directory)
+        directory.addChild(modulation.collection.File("track%03i.ogg"%(i % perDirectory), directory))
+    return root
+
+def benchMemory(files=1000000):
+    """Measures how much memory a collection tree of files leaves needs, and how fast paths are"""
+    before = maxRSS()
+    start = time.time()
+    root = makeDirectoryTree(files)
+    build = time.time() - start
+    used = maxRSS() - before
+    print "Tree: %i files in %.2fs, %.1f MB peak (%.0f bytes/file)"%(
+        files, build, used/1048576.0, used/float(max(files, 1)))
+    start = time.time()
+    count = 0
+    stack = [root]
+    while (len(stack) > 0):
+        for child in stack.pop().contents:
+            if (isinstance(child, modulation.collection.Node)):
+                stack.append(child)
+            else:
+                child.path()
+                count += 1
+    walk = time.time() - start
+    print "Paths: %i in %.2fs (%.0f paths/s)"%(count, walk, count/max(walk, 1e-9))
+    return root
+
+def benchLazy(path, files=100000, budget=4*1048576):
+    """Times opening a LazyDirectoryRoot over a makeTree() tree, and walking it within budget bytes"""
+    makeTree(path, files)
+    start = time.time()
+    root = modulation.collection.LazyDirectoryRoot(path, budget)
+    opened = time.time() - start
+    start = time.time()
+    album = root["artist0000"]["album00"]
+    first = time.time() - start
+    print "LazyDirectoryRoot: opened in %.3fms, listed one album of %i files in %.1fms"%(
+        opened*1000, len(album), first*1000)
+    before = maxRSS()
+    start = time.time()
+    count = 0
+    for media in root.iterMedia(modulation.query.Any(), 0, modulation.query.ORDER_PATH):
+        count += 1
+    walk = time.time() - start
+    print "LazyDirectoryRoot: walked %i files in %.2fs, %i listings, %i unloaded, %.1f MB listed, %.1f MB peak growth"%(
+        count, walk, root.loads, root.evictions, root.memoryUsage()/1048576.0, (maxRSS() - before)/1048576.0)
+    return root
+
+class SyntheticMedia(modulation.media.MediaObject):
+    """A MediaObject with made up metadata and no data"""
+    def __init__(self, path, metadata):
+        super(SyntheticMedia, self).__init__()
+        self.path = path
+        self.collectionPath = path
+        self.__metadata = metadata
+
+    def getMetadata(self):
+        return self.__metadata
+
+class SyntheticLeaf(modulation.collection.Leaf):
+    """A Leaf whose metadata is generated from its position in the library"""
+    __slots__ = ('__index',)
+
+    def __init__(self, name, parent, index):
+        super(SyntheticLeaf, self).__init__(name, parent)
+        self.__index = index
+
+    def media(self):
+        return SyntheticMedia(self.path(), syntheticMetadata(self.__index))
+
+ARTISTS = 97
+ALBUMS = 10
+
+def syntheticMetadata(index):
+    """Returns the made up metadata for the index'th piece of media"""
+    ret = modulation.media.Metadata()
+    ret["artist"] = u"Artist %i"%(index % ARTISTS)
+    ret["album"] = u"Album %i"%((index // ARTISTS) % ALBUMS)
+    ret["title"] = u"Title %i"%(index)
+    #Leave some holes so HasMetadata and Not have something to find
+    if (index % 13 != 0):
+        ret["year"] = 1950 + index % 60
+    return ret
+
+def makeLibrary(entries, perNode=100):
+    """Builds an in-memory collection of SyntheticLeafs"""
+    root = modulation.collection.Node('')
+    node = root
+    for i in xrange(entries):
+        if (i % perNode == 0):
+            node = modulation.collection.Node("node%05i"%(i // perNode), root)
+            root.addChild(node)
+        node.addChild(SyntheticLeaf("leaf%07i"%(i), node, i))
+    return root
+
+def randomConstraint(depth=0):
+    """Returns a random constraint tree over the synthetic metadata"""
+    choice = random.randint(0, 10 if depth < 3 else 7)
+    index = random.randint(0, 10000)
+    if (choice == 0):
+        return modulation.query.EqualsMetadata("artist", u"Artist %i"%(index % ARTISTS))
+    if (choice == 1):
+        return modulation.query.EqualsMetadata("album", u"Album %i"%(index % ALBUMS))
+    if (choice == 2):
+        return modulation.query.HasMetadata("year")
+    if (choice == 3):
+        return modulation.query.GreaterThanMetadata("year", 1950 + index % 60)
+    if (choice == 4):
+        return modulation.query.LessThanMetadata("year", 1950 + index % 60)
+    if (choice == 5):
+        return modulation.query.MetadataGlob("title", u"Title %i*"%(index % 100))
+    if (choice == 6):
+        return modulation.query.ContainsMetadata(u"Artist %i"%(index % ARTISTS))
+    if (choice == 7):
+        return modulation.query.UnderPath("/node%05i"%(index % 20))
+    if (choice == 8):
+        return modulation.query.Not(randomConstraint(depth+1))
+    children = [randomConstraint(depth+1) for i in range(random.randint(0, 3))]
+    if (choice == 9):
+        return modulation.query.And(children)
+    return modulation.query.Or(children)
+
+def checkQueries(dbpath, entries=2000, queries=200, shards=1):
+    """Runs random constraints through DBCache, a MetadataIndex and the in-memory matches()
+
+    Returns the constraints whose results differ, and prints how long each
+    side took in total.
+    """
+    library = makeLibrary(entries)
+    media = []
+    for node in library.contents:
+        for leaf in node.contents:
+            media.append(leaf.media())
+    if (shards > 1):
+        cache = modulation.collection.ShardedDBCache(dbpath, library, shards)
+    else:
+        cache = modulation.collection.DBCache(dbpath, library)
+    start = time.time()
+    cache._updateBackend()
+    print "DBCache: indexed %i entries in %.2fs"%(entries, time.time() - start)
+    start = time.time()
+    library.setIndexed(True)
+    print "MetadataIndex: indexed %i entries in %.2fs"%(entries, time.time() - start)
+    failures = []
+    memoryTime = 0
+    dbTime = 0
+    indexTime = 0
+    for i in xrange(queries):
+        constraint = randomConstraint()
+        start = time.time()
+        expected = set([m.path for m in media if constraint.matches(m)])
+        memoryTime += time.time() - start
+        start = time.time()
+        found = cache.findMedia(constraint, 0, modulation.query.ORDER_PATH)
+        dbTime += time.time() - start
+        start = time.time()
+        indexed = library.findMedia(constraint, 0, modulation.query.ORDER_PATH)
+        indexTime += time.time() - start
+        for (name, found) in (("DBCache", found), ("MetadataIndex", indexed)):
+            if (len(found) != len(expected) or set([m.path for m in found]) != expected):
+                print "%s mismatch for %r: expected %i, got %i"%(name, constraint, len(expected), len(found))
+                failures.append(constraint)
+    print "Queries: %i, %i mismatched, matches() %.3fs, DBCache %.3fs, MetadataIndex %.3fs"%(
+        queries, len(failures), memoryTime, dbTime, indexTime)
+    return failures
+
+def benchSnapshot(path, entries=100000):
+    """Times exporting a snapshot, and how soon a SnapshotCollection over it can answer queries"""
+    library = makeLibrary(entries)
+    start = time.time()
+    modulation.snapshot.export(library, path)
+    print "Snapshot: exported %i entries in %.2fs, %.1f MB"%(
+        entries, time.time() - start, os.path.getsize(path)/1048576.0)
+    start = time.time()
+    collection = modulation.snapshot.SnapshotCollection(path)
+    opened = time.time() - start
+    found = collection.findMedia(modulation.query.EqualsMetadata("artist", u"Artist 1"), 10)
+    first = time.time() - start
+    start = time.time()
+    count = len(collection.findMedia(modulation.query.HasMetadata("year"), 0, modulation.query.ORDER_PATH))
+    scan = time.time() - start
+    start = time.time()
+    collection.findMedia(modulation.query.HasMetadata("year"), 0, modulation.query.ORDER_PATH)
+    rescan = time.time() - start
+    print "Snapshot: opened in %.1fms, first %i results in %.1fms, %i matches in %.2fs cold, %.2fs warm"%(
+        opened*1000, len(found), first*1000, count, scan, rescan)
+
+class StubTag(object):
+    """The tags of a file in a makeTree() tree, made up from its path"""
+    def __init__(self, path):
+        super(StubTag, self).__init__()
+        numbers = [int(x) for x in re.findall(r"\d+", path)[-3:]]
+        while (len(numbers) < 3):
+            numbers.insert(0, 0)
+        (artist, album, track) = numbers
+        album += artist*100
+        #Spread each artist's albums over the whole tree, like a real library
+        self.artist = u"Artist %i"%(album % ARTISTS)
+        self.album = u"Album %i"%(album)
+        self.title = u"Track %i of %i"%(track, album)
+        self.year = 1950 + album % 60
+        self.track = track
+
+class StubProperties(object):
+    def __init__(self, track):
+        super(StubProperties, self).__init__()
+        self.length = 120 + track
+        self.bitrate = 192
+
+class StubFileRef(object):
+    """Stands in for tagpy.FileRef, so empty files can be indexed"""
+    def __init__(self, path):
+        super(StubFileRef, self).__init__()
+        self.__tag = StubTag(path)
+
+    def tag(self):
+        return self.__tag
+
+    def audioProperties(self):
+        return StubProperties(self.__tag.track)
+
+class StubTagLib(object):
+    """Stands in for the tagpy module"""
+    FileRef = StubFileRef
+
+def stubTags():
+    """Makes modulation.media read StubTags instead of using taglib, and returns what it used before"""
+    ret = modulation.media.tagpy
+    modulation.media.tagpy = StubTagLib
+    return ret
+
+def suiteConstraints():
+    """Returns the (name, constraint, order, limit) queries the suite times
+
+    They cover the shapes a stream's playlist typically asks for, over the
+    tags StubTag makes up.
+    """
+    artist = modulation.query.EqualsMetadata("artist", u"Artist 1")
+    return (
+        ("artist", artist, modulation.query.ORDER_PATH, 0),
+        ("album", modulation.query.EqualsMetadata("album", u"Album 1"), modulation.query.ORDER_PATH, 0),
+        ("years", modulation.query.And([modulation.query.LessThanMetadata("year", 1950),
+            modulation.query.GreaterThanMetadata("year", 1960)]), modulation.query.ORDER_RANDOM, 20),
+        ("fulltext", modulation.query.FullTextMatch(u"track 7*"), modulation.query.ORDER_RANDOM, 20),
+        ("notArtist", modulation.query.Not(artist), modulation.query.ORDER_RANDOM, 20),
+        ("either", modulation.query.Or([artist, modulation.query.EqualsMetadata("year", 1999)]), modulation.query.ORDER_PATH, 50),
+        ("any", modulation.query.Any(), modulation.query.ORDER_RANDOM, 100),
+    )
+
+def percentile(samples, fraction):
+    """Returns the sample below which fraction of the sorted samples lie"""
+    return samples[min(len(samples)-1, int(fraction*len(samples)))]
+
+def timeQueries(collection, repeat=20):
+    """Times each of the suiteConstraints() against collection, returning their latencies in ms"""
+    ret = {}
+    for (name, constraint, order, limit) in suiteConstraints():
+        samples = []
+        rows = 0
+        for i in xrange(repeat):
+            start = time.time()
+            rows = len(collection.findMedia(constraint, limit, order))
+            samples.append((time.time() - start)*1000)
+        samples.sort()
+        ret["query.%s.p50_ms"%(name)] = percentile(samples, 0.5)
+        ret["query.%s.p99_ms"%(name)] = percentile(samples, 0.99)
+        ret["query.%s.rows"%(name)] = rows
+    return ret
+
+def benchSuiteSize(directory, files, repeat=20):
+    """Measures scanning, indexing and querying a makeTree() tree of files files
+
+    Returns a dict of measurements. Names ending in _per_s are better when
+    higher, the rest when lower.
+    """
+    ret = {}
+    path = os.path.join(directory, "tree%i"%(files))
+    start = time.time()
+    makeTree(path, files)
+    ret["tree_s"] = time.time() - start
+    before = maxRSS()
+    start = time.time()
+    root = modulation.collection.DirectoryRoot(path)
+    seconds = time.time() - start
+    ret["build_files_per_s"] = files/max(seconds, 1e-9)
+    ret["build_rss_mb"] = (maxRSS() - before)/1048576.0
+    dbpath = os.path.join(directory, "tree%i.db"%(files))
+    if (os.path.exists(dbpath)):
+        os.remove(dbpath)
+    #Every file has to be read the first time, so don't let earlier sizes help
+    modulation.media.setMetadataCache(modulation.media.MetadataCache(0))
+    cache = modulation.collection.DBCache(dbpath, root)
+    start = time.time()
+    cache._indexBackend()
+    seconds = time.time() - start
+    ret["index_files_per_s"] = files/max(seconds, 1e-9)
+    start = time.time()
+    cache._indexBackend()
+    seconds = time.time() - start
+    ret["rescan_files_per_s"] = files/max(seconds, 1e-9)
+    ret["db_mb"] = os.path.getsize(dbpath)/1048576.0
+    ret.update(timeQueries(cache, repeat))
+    ret["peak_rss_mb"] = maxRSS()/1048576.0
+    print "%i files: build %.0f files/s, index %.0f files/s, rescan %.0f files/s, %.1f MB tree, %.1f MB database"%(
+        files, ret["build_files_per_s"], ret["index_files_per_s"], ret["rescan_files_per_s"],
+        ret["build_rss_mb"], ret["db_mb"])
+    return ret
+
+def benchSuite(directory, resultsPath, sizes=(10000, 100000, 1000000), repeat=20):
+    """Runs benchSuiteSize() for each size and writes the results as JSON to resultsPath"""
+    tagpy = stubTags()
+    try:
+        results = {}
+        for files in sorted(sizes):
+            results[str(files)] = benchSuiteSize(directory, files, repeat)
+    finally:
+        modulation.media.tagpy = tagpy
+        modulation.media.setMetadataCache(None)
+    report = {
+        'version': 1,
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(resultsPath, "w") as fh:
+        json.dump(report, fh, indent=2, sort_keys=True)
+    return report
+
+#Changes smaller than this many ms or MB are put down to noise
+SLACK = 1.0
+
+def compareResults(baseline, results, tolerance=0.2):
+    """Returns the (size, name, baseline, result) measurements that got worse by more than tolerance
+
+    Throughput (names ending in _per_s) is worse when it drops, everything
+    else when it grows, although latencies and sizes also have to grow by
+    more than SLACK. Row counts have to match exactly, since a change there
+    means the queries answer differently. Measurements only one side has are
+    skipped.
+    """
+    ret = []
+    for (size, old) in sorted(baseline['results'].iteritems()):
+        new = results['results'].get(size)
+        if (new is None):
+            continue
+        for (name, before) in sorted(old.iteritems()):
+            after = new.get(name)
+            if (after is None):
+                continue
+            if (name.endswith(".rows")):
+                worse = before != after
+            elif (name.endswith("_per_s")):
+                worse = after < before*(1-tolerance)
+            elif (name.endswith("_ms") or name.endswith("_mb")):
+                worse = after > before*(1+tolerance) and after - before > SLACK
+            else:
+                worse = after > before*(1+tolerance)
+            if (worse):
+                ret.append((size, name, before, after))
+    return ret
+
+def measureLateness(work, interval=0.01):
+    """Runs work() while a thread wakes every interval seconds, and returns how late each wakeup was
+
+    The thread stands in for the pacing loop of a stream.
+    """
+    samples = []
+    done = threading.Event()
+    def tick():
+        due = time.time() + interval
+        while (not done.is_set()):
+            time.sleep(max(0, due - time.time()))
+            now = time.time()
+            samples.append(now - due)
+            due = max(due + interval, now)
+    ticker = threading.Thread(target=tick)
+    ticker.start()
+    try:
+        work()
+    finally:
+        done.set()
+        ticker.join()
+    return samples
+
+def benchIndexerJitter(directory, files=20000):
+    """Compares how late a pacing thread wakes up while a DBCache scans in process and in a worker process"""
+    path = os.path.join(directory, "tree")
+    if (not os.path.exists(path)):
+        makeTree(path, files)
+    stubTags()
+    for (name, cache) in (
+            ("in process", lambda db:modulation.collection.DBCache(db, modulation.collection.DirectoryRoot(path))),
+            ("worker process", lambda db:modulation.indexer.ProcessIndexedDBCache(db, modulation.collection.DirectoryRoot, (path,)))):
+        db = os.path.join(directory, "jitter-%s.db"%(name.split()[0]))
+        if (os.path.exists(db)):
+            os.unlink(db)
+        collection = cache(db)
+        start = time.time()
+        samples = sorted(measureLateness(collection.update))
+        elapsed = time.time() - start
+        count = len(collection.findMedia(modulation.query.Any()))
+        if (isinstance(collection, modulation.indexer.ProcessIndexedDBCache)):
+            collection.stop()
+        print "Scan %s: %i files in %.2fs, wakeups late by %.2fms p50, %.2fms p99, %.2fms max"%(
+            name, count, elapsed, percentile(samples, 0.5)*1000, percentile(samples, 0.99)*1000, max(samples)*1000)
+
+class ResultCollector(modulation.Plugin):
+    """Puts the QueryResultPackets it is sent in a Queue, without starting a thread"""
+    def __init__(self):
+        modulation.Plugin.__init__(self)
+        self.results = Queue()
+
+    def acceptPacket(self, pkt):
+        if (isinstance(pkt, modulation.query.QueryResultPacket)):
+            self.results.put(pkt)
+
+def benchBurst(dbpath, entries=20000, burst=16, rounds=20, limit=10):
+    """Sends bursts of identical random QueryPackets to a CollectionManager at once
+
+    Prints how many times the DBCache was actually queried, and how many of
+    the results handed out within a burst were duplicates.
+    """
+    library = makeLibrary(entries)
+    cache = modulation.collection.DBCache(dbpath, library)
+    cache._updateBackend()
+    before = sum([info['count'] for info in cache.queryStats().itervalues()])
+    manager = modulation.collection.CollectionManager()
+    manager.addCollection(cache)
+    collector = ResultCollector()
+    manager.connectOutput(collector)
+    duplicates = 0
+    start = time.time()
+    for i in xrange(rounds):
+        constraint = modulation.query.EqualsMetadata("artist", u"Artist %i"%(i % ARTISTS))
+        for j in xrange(burst):
+            manager.acceptPacket(modulation.query.QueryPacket(collector, constraint, limit))
+        paths = []
+        for j in xrange(burst):
+            paths.extend([media.path for media in collector.results.get(True, 60).media])
+        duplicates += len(paths) - len(set(paths))
+    elapsed = time.time() - start
+    executions = sum([info['count'] for info in cache.queryStats().itervalues()]) - before
+    print "Bursts: %i queries in %.2fs, %i DBCache queries, %i duplicate results"%(
+        burst*rounds, elapsed, executions, duplicates)
+    manager.kill()
+    return (executions, duplicates)
+
+def main(argv):
+    if (len(argv) > 2 and argv[1] == "scan"):
+        path = argv[2]
+        files = 1000000
+        if (len(argv) > 3):
+            files = int(argv[3])
+        start = time.time()
+        makeTree(path, files)
+        print "Synthetic tree: %i files in %.2fs"%(files, time.time() - start)
+        benchDirectoryScan(path)
+        return 0
+    if (len(argv) > 2 and argv[1] == "queries"):
+        args = [int(x) for x in argv[3:6]]
+        if (len(checkQueries(argv[2], *args)) > 0):
+            return 1
+        return 0
+    if (len(argv) > 1 and argv[1] == "memory"):
+        files = 1000000
+        if (len(argv) > 2):
+            files = int(argv[2])
+        benchMemory(files)
+        return 0
+    if (len(argv) > 2 and argv[1] == "lazy"):
+        args = [int(x) for x in argv[3:4]]
+        if (len(argv) > 4):
+            args.append(int(float(argv[4])*1048576))
+        benchLazy(argv[2], *args)
+        return 0
+    if (len(argv) > 2 and argv[1] == "burst"):
+        args = [int(x) for x in argv[3:6]]
+        benchBurst(argv[2], *args)
+        return 0
+    if (len(argv) > 2 and argv[1] == "jitter"):
+        args = [int(x) for x in argv[3:4]]
+        benchIndexerJitter(argv[2], *args)
+        return 0
+    if (len(argv) > 2 and argv[1] == "snapshot"):
+        args = [int(x) for x in argv[3:4]]
+        benchSnapshot(argv[2], *args)
+        return 0
+    if (len(argv) > 3 and argv[1] == "suite"):
+        sizes = [int(x) for x in argv[4:]]
+        if (len(sizes) > 0):
+            benchSuite(argv[2], argv[3], sizes)
+        else:
+            benchSuite(argv[2], argv[3])
+        return 0
+    if (len(argv) > 3 and argv[1] == "compare"):
+        with open(argv[2]) as fh:
+            baseline = json.load(fh)
+        with open(argv[3]) as fh:
+            results = json.load(fh)
+        tolerance = 0.2
+        if (len(argv) > 4):
+            tolerance = float(argv[4])
+        regressions = compareResults(baseline, results, tolerance)
+        for (size, name, before, after) in regressions:
+            print "%s files: %s went from %.3f to %.3f"%(size, name, before, after)
+        print "%i regressions"%(len(regressions))
+        if (len(regressions) > 0):
+            return 1
+        return 0
+    print "Usage: %s scan <directory> [files]"%(argv[0])
+    print "       %s queries <database> [entries] [queries] [shards]"%(argv[0])
+    print "       %s memory [files]"%(argv[0])
+    print "       %s lazy <directory> [files] [budgetMB]"%(argv[0])
+    print "       %s burst <database> [entries] [burst] [rounds]"%(argv[0])
+    print "       %s jitter <directory> [files]"%(argv[0])
+    print "       %s snapshot <file> [entries]"%(argv[0])
+    print "       %s suite <directory> <results.json> [files...]"%(argv[0])
+    print "       %s compare <baseline.json> <results.json> [tolerance]"%(argv[0])
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
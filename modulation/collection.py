@@ -17,32 +17,81 @@
 # along with modulation. If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import with_statement
+import modulation
 import modulation.media
+import modulation.notifications
 import modulation.util
 import modulation.query
+import modulation.querycompiler
+import modulation.inotify
+import modulation.metadataindex
 import os
+import stat
 import logging
 import time
 import sqlite3
 import threading
 import hashlib
+import random
+import re
+import itertools
+import heapq
+import uuid
+from collections import deque
+from Queue import Queue, Empty, Full
+
+#Changes reported to collection listeners
+ADDED = "added"
+REMOVED = "removed"
+MODIFIED = "modified"
+RESCANNED = "rescanned"
+
+#Metadata keys a DBCache keeps in its full text index
+FULLTEXT_KEYS = modulation.query.FullTextMatch.KEYS
+
+def drawShares(counts, limit):
+    """Returns how many of a random sample of limit matches fall to each of counts
+
+    counts is how many matches each source has. Every match is equally likely
+    to be picked, so a source's share is in proportion to its count.
+    """
+    ret = [0]*len(counts)
+    for pick in random.sample(xrange(sum(counts)), min(limit, sum(counts))):
+        for (i, count) in enumerate(counts):
+            if (pick < count):
+                ret[i] += 1
+                break
+            pick -= count
+    return ret
 
 class CollectionObject(object):
-    """Some abstract organizational structure in a collection tree"""
+    """Some abstract organizational structure in a collection tree
+
+    A collection can hold millions of these, so they use __slots__ instead of
+    a per-instance dict and share their name strings.
+    """
+    __slots__ = ('__parent', '__name')
+
     def __init__(self, name, parent=None):
         super(CollectionObject, self).__init__()
+        if (isinstance(name, str)):
+            name = intern(name)
         self.__parent = parent
         self.__name = name
-        self._log = logging.getLogger("modulation.collection.%s"%(self.__class__.__name__))
+
+    @property
+    def _log(self):
+        return logging.getLogger("modulation.collection.%s"%(self.__class__.__name__))
 
     def path(self):
         """Returns the absolute path, in terms of a modulation collection path."""
         if (self.__parent is None):
             return '/'
-        if (self.__parent.path() is "/"):
-            return '/'+self.name()
+        parent = self.__parent.path()
+        if (parent == "/"):
+            return '/'+self.__name
         else:
-            return self.__parent.path()+"/"+self.__name
+            return parent+"/"+self.__name
 
     def name(self):
         """Returns the name of this object in the path"""
@@ -59,11 +108,25 @@ class CollectionObject(object):
         return '%s(%s, %s)'%(self.__class__.__name__, str(self.__name), repr(self.__parent))
 
 class Node(CollectionObject):
-    """Represents an object in the collection tree that has children"""
+    """Represents an object in the collection tree that has children
+
+    Nodes remember their path, so leaves can build theirs on demand.
+    """
+    __slots__ = ('__cache', '__stamp', '__listeners', '__generation', '__path', '__index')
+
     def __init__(self, path, parent=None):
         super(Node, self).__init__(path, parent)
         self.__cache = {}
         self.__stamp = 0
+        self.__listeners = None
+        self.__generation = 0
+        self.__path = None
+        self.__index = None
+
+    def path(self):
+        if (self.__path is None):
+            self.__path = super(Node, self).path()
+        return self.__path
 
     def __getitem__(self, key):
         if (isinstance(key, str)):
@@ -89,36 +152,122 @@ class Node(CollectionObject):
         """Adds a CollectionObject to this node"""
         self.__cache[child.name()] = child
 
+    def removeChild(self, name):
+        """Removes the child with the given name from this node and returns it"""
+        return self.__cache.pop(name)
+
+    def addListener(self, callback):
+        """Registers callback(change, obj) to be called when this node or its children change"""
+        if (self.__listeners is None):
+            self.__listeners = []
+        self.__listeners.append(callback)
+
+    def removeListener(self, callback):
+        """Unregisters a callback added with addListener()"""
+        self.__listeners.remove(callback)
+
+    def generation(self):
+        """Returns a number that goes up whenever the contents of this node change"""
+        return self.__generation
+
+    def _newGeneration(self):
+        """Marks the contents of this node as changed"""
+        self.__generation += 1
+
+    def _notify(self, change, obj):
+        """Tells this node's listeners, and those of its parents, that obj changed"""
+        self._newGeneration()
+        for callback in self.__listeners or ():
+            try:
+                callback(change, obj)
+            except Exception, e:
+                self._log.error("Exception caught from collection listener %s: %s", callback, e)
+        if (not (self.parent() is None)):
+            self.parent()._notify(change, obj)
+
+    def index(self):
+        """Returns this node's MetadataIndex, or None if it doesn't keep one"""
+        return self.__index
+
+    def setIndexed(self, indexed):
+        """Turns the in-memory metadata index for this node on or off
+
+        While it is on, findMedia() answers queries from the index instead of
+        opening every leaf's media. Turning it on reads every leaf's metadata
+        once.
+        """
+        if (indexed and self.__index is None):
+            self.__index = modulation.metadataindex.MetadataIndex(self)
+            self.addListener(self.__index.changed)
+            self.__index.sync()
+        elif (not indexed and not (self.__index is None)):
+            self.removeListener(self.__index.changed)
+            self.__index = None
+
     def setLastUpdateTime(self, time):
         """Sets when this node was last updated"""
         if (time is None):
             time = 0
         self.__stamp = float(time)
 
+    def lastUpdateTime(self):
+        """Returns when this node was last updated"""
+        return self.__stamp
+
+    #Seconds refresh() waits between updates
+    REFRESH_INTERVAL = 3600
+
     def refresh(self):
         """Updates the collection if neccessary"""
-        if (time.time() - self.__stamp > 3600):
-            self.update()
-            self.__stamp = time.time()
-
-    def findMedia(self, constraint, limit):
-        ret = ()
-        for entry in self.contents:
-            if (isinstance(entry, Node)):
-                ret += entry.findMedia(constraint, limit-len(ret))
+        if (time.time() - self.__stamp > self.REFRESH_INTERVAL):
+            self.revalidate()
+
+    def revalidate(self):
+        """Updates the collection now, whether or not it is due"""
+        self.update()
+        if (not (self.__index is None)):
+            self.__index.sync()
+        self.__stamp = time.time()
+        self._newGeneration()
+
+    def findMedia(self, constraint, limit, order=modulation.query.ORDER_RANDOM):
+        """Returns up to limit MediaObjects matching constraint, or all of them if limit is 0"""
+        return tuple(self.iterMedia(constraint, limit, order))
+
+    def iterMedia(self, constraint, limit=0, order=modulation.query.ORDER_RANDOM):
+        """Returns an iterator over the MediaObjects matching constraint, which finds them as it goes"""
+        if (not (self.__index is None)):
+            return self.__index.iterMedia(constraint, limit, order)
+        if (limit > 0):
+            return itertools.islice(self._iterMatches(constraint, order), limit)
+        return self._iterMatches(constraint, order)
+
+    def _children(self, order):
+        if (order == modulation.query.ORDER_PATH):
+            return iter(sorted(self.contents, key=lambda x:x.name()))
+        return iter(self.contents)
+
+    def _iterMatches(self, constraint, order):
+        stack = [self._children(order)]
+        while (len(stack) > 0):
+            for entry in stack[-1]:
+                if (isinstance(entry, Node)):
+                    stack.append(entry._children(order))
+                    break
+                media = entry.media()
+                if (constraint.matches(media)):
+                    yield media
             else:
-                if (constraint.matches(entry.media())):
-                    ret += (entry.media(), )
-                    if (len(ret) == limit):
-                        return ret
-        return ret
-        
+                stack.pop()
+
     def update(self):
         """This function is called from within refresh() if an update is deemed neccessary"""
         pass
 
 class Leaf(CollectionObject):
     """Represents a specific piece of media within a collection hiearchy"""
+    __slots__ = ()
+
     def __init__(self, name, parent=None):
         super(Leaf, self).__init__(name, parent)
     def media(self):
@@ -127,31 +276,214 @@ class Leaf(CollectionObject):
 
 class File(Leaf):
     """A on-disk file with a real path"""
+    __slots__ = ()
+
     def media(self):
-        return modulation.media.FileObject(self.realPath())
+        return modulation.media.FileObject(self.realPath(), self.path())
         
     def realPath(self):
         return '/'.join((self.parent().realPath(), self.name()))
 
+class ScanProgressPacket(modulation.notifications.NotificationPacket):
+    """Sent while a collection is being scanned, and once more when it is done
+
+    seen counts the files walked so far, which were either indexed (read or
+    relinked) or skipped (unchanged, or done before a resumed scan stopped).
+    rate is how many files a second this run got through, and eta how many
+    seconds it should take to finish, or None if that isn't known.
+    """
+    def __init__(self, origin, seen, indexed, skipped, total, rate, eta, done=False):
+        super(ScanProgressPacket, self).__init__(origin)
+        self.__seen = seen
+        self.__indexed = indexed
+        self.__skipped = skipped
+        self.__total = total
+        self.__rate = rate
+        self.__eta = eta
+        self.__done = done
+
+    seen = property(lambda self:self.__seen, None, None, "Files walked so far")
+    indexed = property(lambda self:self.__indexed, None, None, "Files whose entries were read or relinked")
+    skipped = property(lambda self:self.__skipped, None, None, "Files that were already up to date")
+    total = property(lambda self:self.__total, None, None, "Files the scan will walk")
+    rate = property(lambda self:self.__rate, None, None, "Files walked per second")
+    eta = property(lambda self:self.__eta, None, None, "Seconds until the scan is done")
+    done = property(lambda self:self.__done, None, None, "True once the scan has finished")
+
+    def __repr__(self):
+        return "<%s from %r: %i/%i>"%(self.__class__.__name__, self.origin, self.__seen, self.__total)
+
+class ScanProgress(object):
+    """Counts what a scan has done so far, for ScanProgressPackets"""
+    def __init__(self, total):
+        super(ScanProgress, self).__init__()
+        self.total = total
+        self.indexed = 0
+        self.skipped = 0
+        #Files done before a resumed scan stopped, which don't count towards the rate
+        self.resumed = 0
+        self.start = time.time()
+
+    def seen(self):
+        return self.indexed + self.skipped
+
+    def packet(self, origin, done=False):
+        elapsed = max(time.time() - self.start, 1e-9)
+        rate = (self.seen() - self.resumed)/elapsed
+        eta = None
+        if (done):
+            eta = 0
+        elif (rate > 0):
+            eta = max(self.total - self.seen(), 0)/rate
+        return ScanProgressPacket(origin, self.seen(), self.indexed, self.skipped, self.total, rate, eta, done)
+
+class QueryStats(object):
+    """Keeps latency and row counts for each shape of query a collection answers
+
+    Only the most recent SAMPLES latencies of each shape are kept for the
+    percentiles, so the stats follow the collection as it changes.
+    """
+    SAMPLES = 1024
+
+    def __init__(self):
+        super(QueryStats, self).__init__()
+        self.__lock = threading.Lock()
+        self.__shapes = {}
+
+    def record(self, shape, seconds, rows):
+        with self.__lock:
+            info = self.__shapes.get(shape)
+            if (info is None):
+                info = {'count': 0, 'rows': 0, 'max': 0, 'samples': deque(maxlen=self.SAMPLES)}
+                self.__shapes[shape] = info
+            info['count'] += 1
+            info['rows'] += rows
+            info['max'] = max(info['max'], seconds)
+            info['samples'].append(seconds)
+
+    def timed(self, shape, results, finished=None):
+        """Yields results, recording how long it took to produce them under shape
+
+        Only the time spent fetching results counts, not the time the caller
+        spends with each one. If given, finished is called with the seconds
+        and the number of results once they run out or are abandoned.
+        """
+        seconds = 0
+        count = 0
+        try:
+            while True:
+                start = time.time()
+                try:
+                    result = results.next()
+                except StopIteration:
+                    seconds += time.time() - start
+                    return
+                seconds += time.time() - start
+                count += 1
+                yield result
+        finally:
+            self.record(shape, seconds, count)
+            if (not (finished is None)):
+                finished(seconds, count)
+
+    def stats(self):
+        """Returns a dict of statistics for each shape
+
+        'count' is how many queries of the shape were run, 'rows' how many
+        results they returned in total, and 'p50', 'p99' and 'max' are their
+        latencies in seconds.
+        """
+        ret = {}
+        with self.__lock:
+            for (shape, info) in self.__shapes.iteritems():
+                samples = sorted(info['samples'])
+                ret[shape] = {
+                    'count': info['count'],
+                    'rows': info['rows'],
+                    'p50': self.__percentile(samples, 0.5),
+                    'p99': self.__percentile(samples, 0.99),
+                    'max': info['max'],
+                }
+        return ret
+
+    def __percentile(self, samples, fraction):
+        if (len(samples) == 0):
+            return None
+        return samples[min(len(samples)-1, int(fraction*len(samples)))]
+
+    def clear(self):
+        with self.__lock:
+            self.__shapes.clear()
+
+class StatementTrace(object):
+    """Times the statements a query runs, and keeps the slowest so it can be logged"""
+    def __init__(self):
+        super(StatementTrace, self).__init__()
+        self.count = 0
+        #(seconds, sql, binds) of the slowest statement so far
+        self.slowest = None
+
+    def fetch(self, c, sql, binds=()):
+        """Runs sql on the cursor c and returns every row it finds"""
+        start = time.time()
+        c.execute(sql, binds)
+        rows = c.fetchall()
+        seconds = time.time() - start
+        self.count += 1
+        if (self.slowest is None or seconds > self.slowest[0]):
+            self.slowest = (seconds, sql, binds)
+        return rows
+
 class DBCache(Node):
     """A node that sits on top of some other, slower node
     
     A DBCache stores a backend object's hiearchy on disk in a sqlite database.
     This greatly speeds up operations, since searching a filesystem or remote URL
     for a specific piece of metadata can be dreadful and sometimes unrealistic.
+
+    Every query is timed into a QueryStats, and ones slower than SLOW_QUERY
+    seconds are logged along with their SQL and query plan.
+
+    Full scans checkpoint how far they got in _meta, so a scan that was
+    interrupted carries on where it stopped the next time. Their progress is
+    sent to progress listeners as ScanProgressPackets.
     """
-    def __init__(self, path, backend):
+    #Seconds between ScanProgressPackets
+    PROGRESS_INTERVAL = 1.0
+
+    #Seconds a query may take before it is logged as slow
+    SLOW_QUERY = 0.5
+
+    def __init__(self, path, backend, shard=0, shards=1, incrementalVacuum=False):
         super(DBCache, self).__init__('', None)
         self.__db = modulation.util.ThreadingSqliteDB(path)
-        with self.__db as db:
-            db.create_function('regexp', 2, self.__regexp)
-            #db.create_function('glob', 2, self.__glob)
+        self.__db.createFunction('regexp', 2, self.__regexp)
+        self.__db.createFunction('fulltext_term', 3, self.__fullTextTerm)
         self.__backend = backend
+        self.__paths = {}
+        self.__shard = shard
+        self.__shards = shards
+        self.__incrementalVacuum = incrementalVacuum
+        self.__slowQuery = self.SLOW_QUERY
+        self.__progressListeners = []
+        self.__queryStats = QueryStats()
         self.__initdb()
-        self.__updateThread = None
+        self.__scan = int(self.getMeta('scan') or 0)
+        if (incrementalVacuum):
+            self._enableIncrementalVacuum()
+        self.__compiler = modulation.querycompiler.QueryCompiler(self._hasTable('fulltext'), self._lookupPathId)
+        if (isinstance(backend, Node)):
+            backend.addListener(self._backendChanged)
         
     def __regexp(self, pattern, string):
-        return re.match(pattern, string)
+        if (string is None):
+            return False
+        return re.match(pattern, modulation.query._text(string)) is not None
+
+    def __fullTextTerm(self, value, phrase, prefix):
+        if (value is None):
+            return False
+        return modulation.query._hasPhrase(modulation.query._words(value), phrase.split(' '), prefix)
 
     def __initdb(self):
         with self.__db as db:
@@ -163,9 +495,20 @@ class DBCache(Node):
                 db.commit()
                 c.close()
                 version = None
-            newver = str(self.upgradeDB(version))
-            if (not newver is None):
-                self.setMeta('_version', newver)
+            #Older releases stored 'None' once the first schema was created
+            if (version == 'None'):
+                version = 1
+            elif (not version is None):
+                version = int(version)
+            newver = self.upgradeDB(version)
+            if (newver != version):
+                self.setMeta('_version', str(newver))
+            layout = "%i/%i"%(self.__shard, self.__shards)
+            stored = self.getMeta('shard')
+            if (stored is None):
+                self.setMeta('shard', layout)
+            elif (stored != layout):
+                raise ValueError, "Database is shard %s, not %s"%(stored, layout)
             self.setLastUpdateTime(self.getMeta('last_update'))
 
     def getMeta(self, key):
@@ -188,39 +531,309 @@ class DBCache(Node):
             c.close()
 
     def upgradeDB(self, currentVersion):
-        """Called when the database needs upgrading to the latest version"""
-        if (currentVersion is None):
-            with self.__db as db:
-                c = db.cursor()
-                #TODO: Store in a preorder tree format
+        """Called when the database needs upgrading to the latest version
+
+        Returns the version the database is at afterwards.
+        """
+        with self.__db as db:
+            c = db.cursor()
+            if (currentVersion is None):
                 c.execute("CREATE TABLE paths (id INTEGER PRIMARY KEY, parent INTEGER KEY, name TEXT)")
                 c.execute("CREATE UNIQUE INDEX parentname ON paths (parent, name)")
                 c.execute("CREATE TABLE entries (id INTEGER PRIMARY KEY, pathid INTEGER KEY, name TEXT, path_sha1 TEXT)")
                 c.execute("CREATE TABLE metadata (entryid INTEGER KEY, name TEXT, value BLOB)")
                 c.execute("CREATE UNIQUE INDEX idname ON metadata (entryid, name)")
-                db.commit()
-                c.close()
-                return 1
+                currentVersion = 1
+            if (currentVersion < 2):
+                #The backend's real path, so results don't need a tree walk
+                c.execute("ALTER TABLE entries ADD COLUMN realpath TEXT")
+                currentVersion = 2
+            if (currentVersion < 3):
+                #Lets metadata predicates be answered from the index alone
+                c.execute("CREATE INDEX namevalue ON metadata (name, value, entryid)")
+                currentVersion = 3
+            if (currentVersion < 4):
+                #Numbers get their own typed column so range queries can use an index
+                c.execute("ALTER TABLE metadata ADD COLUMN numvalue REAL")
+                c.execute("UPDATE metadata SET numvalue = value WHERE typeof(value) IN ('integer', 'real')")
+                c.execute("CREATE INDEX namenumvalue ON metadata (name, numvalue, entryid)")
+                currentVersion = 4
+            if (currentVersion < 5):
+                #Full text search over the commonly searched keys, keyed by entry id
+                try:
+                    c.execute("CREATE VIRTUAL TABLE fulltext USING fts5(%s)"%(', '.join(FULLTEXT_KEYS)))
+                    c.execute("INSERT INTO fulltext (rowid, %s) SELECT entries.id, %s FROM entries"%(
+                        ', '.join(FULLTEXT_KEYS),
+                        ', '.join(["(SELECT value FROM metadata WHERE entryid = entries.id AND name = '%s')"%(key) for key in FULLTEXT_KEYS])))
+                except sqlite3.OperationalError, e:
+                    self._log.warn("Full text search is unavailable: %s", e)
+                currentVersion = 5
+            if (currentVersion < 6):
+                #Lets path ordered results be read a page at a time
+                c.execute("CREATE INDEX realpathorder ON entries (coalesce(realpath, ''), id)")
+                currentVersion = 6
+            if (currentVersion < 7):
+                #Lets unchanged files be skipped, and moved files be found by their contents
+                c.execute("ALTER TABLE entries ADD COLUMN contentid TEXT")
+                c.execute("ALTER TABLE entries ADD COLUMN size INTEGER")
+                c.execute("ALTER TABLE entries ADD COLUMN mtime REAL")
+                c.execute("CREATE INDEX contentid ON entries (contentid)")
+                #Every scanned file is looked up by the hash of its path
+                c.execute("CREATE INDEX pathhash ON entries (path_sha1)")
+                #Removed entries whose metadata is kept in case their file turns up elsewhere
+                c.execute("CREATE TABLE orphans (entryid INTEGER PRIMARY KEY, contentid TEXT, removed REAL)")
+                c.execute("CREATE INDEX orphancontent ON orphans (contentid)")
+                currentVersion = 7
+            if (currentVersion < 8):
+                #The last full scan that saw each entry, so ones that are gone can be swept
+                c.execute("ALTER TABLE entries ADD COLUMN scan INTEGER")
+                c.execute("CREATE INDEX entryscan ON entries (scan)")
+                currentVersion = 8
+            if (currentVersion < 9):
+                #Every path's ancestors, itself included, so a subtree is one range of the primary key
+                c.execute("CREATE TABLE path_closure (ancestor INTEGER, descendant INTEGER, depth INTEGER, "
+                    "PRIMARY KEY (ancestor, descendant)) WITHOUT ROWID")
+                c.execute("CREATE INDEX closuredescendant ON path_closure (descendant)")
+                c.execute("WITH RECURSIVE closure (ancestor, descendant, depth) AS ("
+                    "SELECT id, id, 0 FROM paths UNION ALL "
+                    "SELECT paths.parent, closure.descendant, closure.depth+1 FROM closure JOIN paths ON paths.id = closure.ancestor "
+                    "WHERE paths.parent IN (SELECT id FROM paths)) "
+                    "INSERT INTO path_closure (ancestor, descendant, depth) SELECT ancestor, descendant, depth FROM closure")
+                c.execute("CREATE INDEX entrypath ON entries (pathid)")
+                currentVersion = 9
+            db.commit()
+            c.close()
+        return currentVersion
 
-    def findMedia(self, constraint, limit=0):
+    def useWriteAheadLog(self):
+        """Switches the database to WAL journaling, which it keeps from then on
+
+        Readers then never wait for a writer, even one in another process.
+        """
+        with self.__db as db:
+            mode = db.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        if (mode.lower() != "wal"):
+            self._log.warn("Could not switch to WAL journaling, still using %s", mode)
+
+    def _hasTable(self, name):
+        """Returns true if the database has a table called name"""
+        with self.__db as db:
+            c = db.cursor()
+            c.execute("SELECT name FROM sqlite_master WHERE name = ?", (name,))
+            ret = c.fetchone()
+            c.close()
+        return not (ret is None)
+
+    def findMedia(self, constraint, limit=0, order=modulation.query.ORDER_RANDOM):
         """Accepts a mediaman.query.Query object and returns a list of MediaObjects"""
-        (wherecond, binds) = self._buildQueryConditions(constraint)
+        return tuple(self.iterMedia(constraint, limit, order))
+
+    #How many rows to read from the database at a time
+    PAGE_SIZE = 500
+
+    def iterMedia(self, constraint, limit=0, order=modulation.query.ORDER_RANDOM):
+        """Yields the MediaObjects matching constraint, reading them from the database a page at a time
+
+        Random results are sampled without sorting every matching row, so the
+        cost of a limited query depends on the limit rather than the number of
+        matches.
+        """
+        for row in self._iterRows(constraint, limit, order):
+            yield self._rowMedia(row)
+
+    def countMatches(self, constraint):
+        """Returns how many entries match constraint"""
+        (wherecond, binds) = self.__compiler.compile(constraint)
+        with self.__db as db:
+            c = db.cursor()
+            c.execute("SELECT COUNT(*) AS count FROM entries WHERE %s"%(wherecond,), binds)
+            ret = c.fetchone()['count']
+            c.close()
+        return ret
+
+    def queryStats(self):
+        """Returns the QueryStats.stats() of the queries run so far
+
+        The shapes are the ones queryShape() returns.
+        """
+        return self.__queryStats.stats()
+
+    def queryShape(self, constraint, order, limit):
+        """Returns the (constraint shape, order, limited) tuple queries are grouped by in queryStats()
+
+        The constraint shape comes from QueryCompiler.shape().
+        """
+        return (self.__compiler.shape(constraint), order, limit > 0)
+
+    def setSlowQueryThreshold(self, seconds):
+        """Changes how long a query may take before it is logged, or never logs them if None"""
+        self.__slowQuery = seconds
+
+    def _iterRows(self, constraint, limit, order):
+        """Yields the entries rows matching constraint, like iterMedia()"""
+        (wherecond, binds) = self.__compiler.compile(constraint)
         self._log.debug("Querying for %s with %s", wherecond, binds)
-        ret = ()
+        shape = self.queryShape(constraint, order, limit)
+        trace = StatementTrace()
+        def finished(seconds, count):
+            if (not (self.__slowQuery is None) and seconds >= self.__slowQuery):
+                self._logSlowQuery(constraint, trace, order, limit, seconds, count)
+        return self.__queryStats.timed(shape, self.__rows(wherecond, binds, order, limit, trace), finished)
+
+    def __rows(self, wherecond, binds, order, limit, trace):
+        if (order == modulation.query.ORDER_PATH):
+            return self._iterPathOrdered(wherecond, binds, limit, trace)
+        elif (limit > 0):
+            return self.__sampled(wherecond, binds, limit, trace)
+        else:
+            return self._iterShuffled(wherecond, binds, trace)
+
+    def __sampled(self, wherecond, binds, limit, trace):
         with self.__db as db:
             c = db.cursor()
+            rows = self._sampleRows(c, wherecond, binds, limit, trace)
+            c.close()
+        for row in rows:
+            yield row
+
+    def _logSlowQuery(self, constraint, trace, order, limit, seconds, count):
+        """Logs a slow query with the slowest statement it ran, and the plan sqlite used for it"""
+        if (trace.slowest is None):
+            self._log.warn("Slow query took %.3fs for %i rows (order %s, limit %i) without running any SQL: %r",
+                seconds, count, order, limit, constraint)
+            return
+        (statementSeconds, sql, binds) = trace.slowest
+        try:
+            with self.__db as db:
+                c = db.cursor()
+                c.execute("EXPLAIN QUERY PLAN "+sql, binds)
+                plan = '\n'.join(["    %s"%(row[-1],) for row in c.fetchall()])
+                c.close()
+        except sqlite3.Error, e:
+            plan = "    (no plan: %s)"%(e,)
+        self._log.warn("Slow query took %.3fs for %i rows (order %s, limit %i): %r\n"
+            "Slowest of its %i statements took %.3fs: %s\nBinds: %r\nPlan:\n%s",
+            seconds, count, order, limit, constraint, trace.count, statementSeconds, sql, binds, plan)
+
+    def _iterPathOrdered(self, wherecond, binds, limit, trace=None):
+        """Yields the rows matching wherecond ordered by path, one page per statement"""
+        if (trace is None):
+            trace = StatementTrace()
+        last = None
+        count = 0
+        while True:
+            size = self.PAGE_SIZE
             if (limit > 0):
-                c.execute("SELECT entries.name, entries.pathid FROM entries LEFT JOIN metadata ON metadata.entryid = entries.id WHERE %s ORDER BY RANDOM() LIMIT ?"%(wherecond,), binds+(limit,))
-            else:
-                c.execute("SELECT entries.name, entries.pathid FROM entries LEFT JOIN metadata ON metadata.entryid = entries.id WHERE %s ORDER BY RANDOM()"%(wherecond,), binds)
-            rows = c.fetchall()
+                size = min(size, limit-count)
+            with self.__db as db:
+                c = db.cursor()
+                if (last is None):
+                    rows = trace.fetch(c, "SELECT entries.id, entries.name, entries.pathid, entries.realpath FROM entries WHERE (%s) ORDER BY coalesce(entries.realpath, ''), entries.id LIMIT ?"%(wherecond,), binds+(size,))
+                else:
+                    rows = trace.fetch(c, "SELECT entries.id, entries.name, entries.pathid, entries.realpath FROM entries WHERE (coalesce(entries.realpath, '') > ? OR (coalesce(entries.realpath, '') = ? AND entries.id > ?)) AND (%s) ORDER BY coalesce(entries.realpath, ''), entries.id LIMIT ?"%(wherecond,), (last[0], last[0], last[1])+binds+(size,))
+                c.close()
             for row in rows:
-                backendPath = self._getFullPath(row['pathid'])
-                backendPath = '/'.join(backendPath.split('/')[1:])
-                ret += (self._getMedia('/'.join((backendPath, row['name'])), self.__backend),)
+                yield row
+            count += len(rows)
+            if (len(rows) < size or (limit > 0 and count >= limit)):
+                return
+            last = (rows[-1]['realpath'] or '', rows[-1]['id'])
+
+    def _iterShuffled(self, wherecond, binds, trace=None):
+        """Yields every row matching wherecond in random order, one page per statement"""
+        if (trace is None):
+            trace = StatementTrace()
+        with self.__db as db:
+            c = db.cursor()
+            ids = [row['id'] for row in trace.fetch(c, "SELECT entries.id FROM entries WHERE %s"%(wherecond,), binds)]
             c.close()
+        random.shuffle(ids)
+        for start in range(0, len(ids), self.PAGE_SIZE):
+            chunk = ids[start:start+self.PAGE_SIZE]
+            with self.__db as db:
+                c = db.cursor()
+                rows = dict([(row['id'], row) for row in self._rowsById(c, chunk, "1", (), trace)])
+                c.close()
+            for id in chunk:
+                if (id in rows):
+                    yield rows[id]
+
+    #How many rounds of random id probes to try before sampling from every match
+    SAMPLE_ROUNDS = 3
+    #The most ids bound to a single statement
+    SAMPLE_CHUNK = 500
+
+    def _sampleRows(self, c, wherecond, binds, limit, trace=None):
+        """Returns up to limit random rows matching wherecond
+
+        Random ids are drawn from the id range and checked against the
+        constraint, which finds enough matches in a few rounds unless the
+        constraint is very selective. Only then is the (small) list of matching
+        ids read and sampled from.
+        """
+        if (trace is None):
+            trace = StatementTrace()
+        bounds = trace.fetch(c, "SELECT MIN(id) AS low, MAX(id) AS high FROM entries")[0]
+        if (bounds['low'] is None):
+            return []
+        span = bounds['high'] - bounds['low'] + 1
+        found = {}
+        probe = limit*2
+        for i in range(self.SAMPLE_ROUNDS):
+            size = min(probe, span)
+            ids = random.sample(xrange(bounds['low'], bounds['high']+1), size)
+            for row in self._rowsById(c, ids, wherecond, binds, trace):
+                found[row['id']] = row
+            if (len(found) >= limit or size == span):
+                break
+            probe *= 4
+        else:
+            remaining = [row['id'] for row in trace.fetch(c, "SELECT entries.id FROM entries WHERE %s"%(wherecond,), binds) if not row['id'] in found]
+            ids = random.sample(remaining, min(limit-len(found), len(remaining)))
+            for row in self._rowsById(c, ids, wherecond, binds, trace):
+                found[row['id']] = row
+        ret = found.values()
+        random.shuffle(ret)
+        return ret[:limit]
+
+    def _rowsById(self, c, ids, wherecond, binds, trace=None):
+        """Returns the rows out of ids that match wherecond"""
+        if (trace is None):
+            trace = StatementTrace()
+        ret = []
+        for start in range(0, len(ids), self.SAMPLE_CHUNK):
+            chunk = tuple(ids[start:start+self.SAMPLE_CHUNK])
+            ret.extend(trace.fetch(c, "SELECT entries.id, entries.name, entries.pathid, entries.realpath FROM entries WHERE entries.id IN (%s) AND (%s)"%(','.join('?'*len(chunk)), wherecond), chunk+binds))
         return ret
 
+    def _rowMedia(self, row):
+        """Builds the MediaObject for an entries row"""
+        path = '/'.join((self._getFullPath(row['pathid']), row['name']))
+        if (not (row['realpath'] is None)):
+            return modulation.media.FileObject(row['realpath'], path)
+        return self._getMedia(path[1:], self.__backend)
+
+    def snapshotEntries(self):
+        """Yields (path, realpath, metadata) for every entry in path order, for modulation.snapshot"""
+        page = []
+        for row in itertools.chain(self._iterPathOrdered("1", (), 0), (None,)):
+            if (not (row is None)):
+                page.append(row)
+                if (len(page) < self.PAGE_SIZE):
+                    continue
+            metadata = dict([(row['id'], modulation.media.Metadata()) for row in page])
+            with self.__db as db:
+                c = db.cursor()
+                for start in range(0, len(page), self.SAMPLE_CHUNK):
+                    chunk = tuple([row['id'] for row in page[start:start+self.SAMPLE_CHUNK]])
+                    c.execute("SELECT entryid, name, value FROM metadata WHERE entryid IN (%s)"%(','.join('?'*len(chunk))), chunk)
+                    for meta in c.fetchall():
+                        metadata[meta['entryid']][meta['name']] = meta['value']
+                c.close()
+            for row in page:
+                yield ('/'.join((self._getFullPath(row['pathid']), row['name'])), row['realpath'], metadata[row['id']])
+            page = []
+
     def _buildGroupConditions(self, filter):
         if (isinstance(filter, modulation.query.Limit)):
             return "LIMIT %i"%filter.size()
@@ -235,6 +848,8 @@ class DBCache(Node):
         return None
 
     def _getFullPath(self, pathid):
+        if (pathid in self.__paths):
+            return self.__paths[pathid]
         with self.__db as db:
             c = db.cursor()
             c.execute("SELECT parent, name FROM paths WHERE id = ?", (pathid,))
@@ -246,93 +861,407 @@ class DBCache(Node):
                 return ''
             parent = self._getFullPath(path['parent'])
             ret = '/'.join((parent, path['name']))
+            self.__paths[pathid] = ret
             return ret
 
-    def _buildQueryConditions(self, constraint):
-        if (isinstance(constraint, modulation.query.Any)):
-            return ("1==1",())
-        if (isinstance(constraint, modulation.query.Nothing)):
-            return ("1==0",())
-        if (isinstance(constraint, modulation.query.Not)):
-            ret = self._buildQueryConditions(constraint.constraint())
-            return ("NOT (%s)"%ret[0], ret[1])
-        if (isinstance(constraint, modulation.query.MetadataQuery)):
-            return self._buildMetadataQueryConditions(constraint)
-        if (isinstance(constraint, modulation.query.Or)):
-            query = ()
-            binds = ()
-            for subquery in constraint.constraints:
-                subq = self._buildQueryConditions(subquery)
-                query += (subq[0],)
-                binds += subq[1]
-            return (' OR '.join(query), binds)
-        if (isinstance(constraint, modulation.query.And)):
-            query = ()
-            binds = ()
-            for subquery in constraint.constraints:
-                subq = self._buildQueryConditions(subquery)
-                query += (subq[0],)
-                binds += subq[1]
-            return (' AND '.join(query), binds)
-        if (isinstance(constraint, modulation.query.RandomMatch)):
-            if (constraint.getBool()):
-                return ('1=1', ())
-            return ('1=0', ())
-
-    def _buildMetadataQueryConditions(self, constraint):
-        if (isinstance(constraint, modulation.query.EqualsMetadata)):
-            return ("(metadata.name == ? AND ? == metadata.value)",(constraint.key(), constraint.value()))
-        if (isinstance(constraint, modulation.query.HasMetadata)):
-            return ("(metadata.name == ?)", (constraint.key(),))
-        if (isinstance(constraint, modulation.query.GreaterThanMetadata)):
-            return ("(metadata.name == ? AND ? > metadata.value)", (constraint.key(), constraint.value()))
-        if (isinstance(constraint, modulation.query.LessThanMetadata)):
-            return ("(metadata.name == ? AND ? < metadata.value)", (constraint.key(), constraint.value()))
-        if (isinstance(constraint, modulation.query.ContainsMetadata)):
-            return ("metadata.value == ?", (constraint.key()))
-        if (isinstance(constraint, modulation.query.MetadataRegex)):
-            return ("(metadata.name == ? AND metadata.value  REGEX ?)", (constraint.key(), constraint.value()))
-        if (isinstance(constraint, modulation.query.MetadataGlob)):
-            return ("(metadata.name == ? AND metadata.value GLOB ?)", (constraint.key(), constraint.value()))
-
     def update(self):
-        """Updates the backend in the background"""
-        if (self.__updateThread is None):
-            self.__updateThread = threading.Thread(target=self._updateBackend)
-            self.__updateThread.start()
-        else:
-            self.__updateThread.join()
-            self.__updateThread = None
-    
+        """Rescans the backend and brings the database in line with it
+
+        This blocks until the scan is done; use a RefreshScheduler to run it
+        in the background.
+        """
+        self._updateBackend()
+
     def _updateBackend(self):
         self.__backend.update()
-        self._updateNode(self.__backend)
+        self._indexBackend()
+
+    def addProgressListener(self, callback):
+        """Registers callback(packet) to be given a ScanProgressPacket as scans go on"""
+        self.__progressListeners.append(callback)
+
+    def removeProgressListener(self, callback):
+        self.__progressListeners.remove(callback)
+
+    def _sendProgress(self, progress, done=False):
+        self._dispatchProgress(progress.packet(self, done))
+
+    def _dispatchProgress(self, packet):
+        """Hands a ScanProgressPacket to the progress listeners"""
+        for callback in list(self.__progressListeners):
+            try:
+                callback(packet)
+            except Exception, e:
+                self._log.error("Exception caught from progress listener %s: %s", callback, e)
+
+    def _indexBackend(self):
+        """Brings the database in line with the backend's current tree
+
+        Every entry the scan sees is stamped with the scan's number, and the
+        ones left with an older stamp afterwards are swept. The backend is
+        walked in path order, and the path of the last leaf stamped is kept
+        in _meta as scan_checkpoint until the scan is done, so an interrupted
+        scan can carry on from it with the same scan number.
+        """
+        checkpoint = self.getMeta('scan_checkpoint')
+        if (checkpoint is None):
+            self.__scan += 1
+            self.setMeta('scan', str(self.__scan))
+            self.setMeta('scan_checkpoint', '')
+            after = None
+        else:
+            self._log.info("Resuming scan %i after %r", self.__scan, checkpoint)
+            after = checkpoint.split('/')
+            if (checkpoint == ''):
+                after = None
+        progress = ScanProgress(self._countOwned(self.__backend))
+        self._updateNode(self.__backend, progress, after)
+        self._sendProgress(progress, True)
+        swept = self._sweep(self.__scan)
+        self._purgeOrphans(time.time() - self.ORPHAN_TIMEOUT)
+        paths = self._compactPaths()
+        if (self.__incrementalVacuum):
+            self._vacuum()
+        self._log.info("Scan %i indexed %i files, skipped %i, and swept %i entries and %i paths",
+            self.__scan, progress.indexed, progress.skipped, swept, paths)
+        self.setMeta('scan_checkpoint', None)
         self.setMeta('last_update', time.time())
+        self._newGeneration()
+
+    #How many entries are stamped or swept per statement
+    SWEEP_BATCH = 500
+
+    def _stampEntries(self, ids):
+        """Marks entries as seen by the current scan"""
+        with self.__db as db:
+            c = db.cursor()
+            for start in range(0, len(ids), self.SWEEP_BATCH):
+                chunk = tuple(ids[start:start+self.SWEEP_BATCH])
+                c.execute("UPDATE entries SET scan = ? WHERE id IN (%s)"%(','.join('?'*len(chunk))), (self.__scan,)+chunk)
+            db.commit()
+            c.close()
+
+    def _sweep(self, scan):
+        """Removes the entries that scan didn't see, a batch at a time, and returns how many there were
+
+        Entries with a content id are orphaned rather than forgotten, in case
+        their file turns up again.
+        """
+        ret = 0
+        while True:
+            with self.__db as db:
+                c = db.cursor()
+                c.execute("SELECT id, contentid FROM entries WHERE scan IS NULL OR scan < ? LIMIT ?", (scan, self.SWEEP_BATCH))
+                rows = c.fetchall()
+                if (len(rows) == 0):
+                    c.close()
+                    return ret
+                now = time.time()
+                ids = tuple([row['id'] for row in rows])
+                marks = ','.join('?'*len(ids))
+                c.executemany("INSERT OR REPLACE INTO orphans (entryid, contentid, removed) VALUES (?,?,?)",
+                    [(row['id'], row['contentid'], now) for row in rows if not (row['contentid'] is None)])
+                c.execute("DELETE FROM metadata WHERE entryid IN (%s) AND entryid NOT IN (SELECT entryid FROM orphans)"%(marks), ids)
+                c.execute("DELETE FROM entries WHERE id IN (%s)"%(marks), ids)
+                if (self.__compiler.fulltext()):
+                    c.execute("DELETE FROM fulltext WHERE rowid IN (%s)"%(marks), ids)
+                db.commit()
+                c.close()
+            ret += len(rows)
+
+    def _compactPaths(self):
+        """Removes the paths nothing is stored under any more, and returns how many there were"""
+        ret = 0
+        with self.__db as db:
+            c = db.cursor()
+            while True:
+                c.execute("DELETE FROM paths WHERE id NOT IN (SELECT pathid FROM entries WHERE pathid IS NOT NULL) "
+                    "AND id NOT IN (SELECT parent FROM paths WHERE parent IS NOT NULL)")
+                if (c.rowcount <= 0):
+                    break
+                ret += c.rowcount
+            if (ret > 0):
+                c.execute("DELETE FROM path_closure WHERE descendant NOT IN (SELECT id FROM paths)")
+            db.commit()
+            c.close()
+        if (ret > 0):
+            #Path ids can be handed out again now
+            self._forgetPaths()
+        return ret
+
+    def _forgetPaths(self):
+        """Drops the cached names of path ids, which may since have been reused"""
+        self.__paths = {}
+
+    #How many free pages each incremental vacuum step gives back
+    VACUUM_PAGES = 1024
+
+    def _enableIncrementalVacuum(self):
+        """Switches the database to incremental auto vacuum, which needs a full VACUUM the first time"""
+        with self.__db as db:
+            mode = db.execute("PRAGMA auto_vacuum").fetchone()[0]
+            if (mode != 2):
+                db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                try:
+                    db.execute("VACUUM")
+                except sqlite3.OperationalError, e:
+                    self._log.warn("Could not switch to incremental vacuum: %s", e)
+
+    def _vacuum(self):
+        """Gives free pages back to the filesystem, a few at a time
+
+        This stops as soon as a step frees nothing, which is every time if the
+        database never made it to incremental auto vacuum.
+        """
+        with self.__db as db:
+            if (db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2):
+                self._log.debug("Not vacuuming, the database isn't in incremental auto vacuum mode")
+                return
+        while True:
+            with self.__db as db:
+                free = db.execute("PRAGMA freelist_count").fetchone()[0]
+                if (free == 0):
+                    return
+                db.execute("PRAGMA incremental_vacuum(%i)"%(self.VACUUM_PAGES)).fetchall()
+                db.commit()
+                if (db.execute("PRAGMA freelist_count").fetchone()[0] >= free):
+                    return
+
+    #Seconds the metadata of a removed entry is kept in case its file turns up again
+    ORPHAN_TIMEOUT = 86400
+
+    def _purgeOrphans(self, before):
+        """Forgets the metadata of entries removed before the given time"""
+        with self.__db as db:
+            c = db.cursor()
+            c.execute("DELETE FROM metadata WHERE entryid IN (SELECT entryid FROM orphans WHERE removed < ?)", (before,))
+            c.execute("DELETE FROM orphans WHERE removed < ?", (before,))
+            db.commit()
+            c.close()
+
+    def owns(self, leaf):
+        """Returns true if leaf belongs in this database's shard"""
+        return self._ownsHash(hashlib.sha1(leaf.path()).hexdigest())
+
+    def _ownsHash(self, hash):
+        if (self.__shards == 1):
+            return True
+        return int(hash[:8], 16) % self.__shards == self.__shard
+
+    def _backendChanged(self, change, obj):
+        """Applies a single change reported by the backend to the database"""
+        self._log.debug("Backend reported %s: %s", change, obj)
+        if (change == REMOVED):
+            if (isinstance(obj, Leaf)):
+                self._removeLeaf(obj)
+            else:
+                self._removeNode(obj)
+        else:
+            if (isinstance(obj, Leaf)):
+                id = self._updateLeaf(obj)
+                if (not (id is None)):
+                    self._stampEntries([id])
+            else:
+                self._updateNode(obj)
+        self._newGeneration()
 
     def _findLeafByPathHash(self, hash):
         with self.__db as db:
             c = db.cursor()
-            c.execute("SELECT id, pathid, name FROM entries WHERE path_sha1 = ?", (hash,))
+            c.execute("SELECT id, pathid, name, realpath, contentid, size, mtime FROM entries WHERE path_sha1 = ?", (hash,))
             ret = c.fetchone()
             c.close()
             return ret
 
-    def _updateNode(self, node):
+    def _countOwned(self, node):
+        """Returns how many leaves beneath node belong in this shard"""
+        ret = 0
+        stack = [node]
+        while (len(stack) > 0):
+            for child in stack.pop().contents:
+                if (isinstance(child, Node)):
+                    stack.append(child)
+                elif (self.__shards == 1 or self.owns(child)):
+                    ret += 1
+        return ret
+
+    def _updateNode(self, node, progress=None, after=None):
+        """Brings the entries beneath node up to date, walking them in path order
+
+        A full scan passes a ScanProgress, which makes the walk report its
+        progress and checkpoint each batch of stamped entries. Leaves up to
+        and including the path components in after are left alone, since an
+        interrupted scan already did them. The writes share one connection,
+        and are committed once per SWEEP_BATCH stamped entries.
+        """
+        try:
+            with self.__db.batch():
+                self.__walkNode(node, progress, after)
+        except Exception, e:
+            #Path ids handed out in the rolled back batch are gone again
+            self._forgetPaths()
+            raise
+
+    def __walkNode(self, node, progress, after):
+        seen = []
+        last = None
+        lastProgress = time.time()
+        stack = [iter(sorted(node.contents, key=lambda x:x.name()))]
+        while (len(stack) > 0):
+            for child in stack[-1]:
+                if (not (after is None)):
+                    parts = child.path().split('/')
+                    if (isinstance(child, Node) and parts < after[:len(parts)]):
+                        done = self._countOwned(child)
+                        progress.skipped += done
+                        progress.resumed += done
+                        continue
+                    if (isinstance(child, Leaf) and parts <= after):
+                        if (self.__shards == 1 or self.owns(child)):
+                            progress.skipped += 1
+                            progress.resumed += 1
+                        continue
+                if (isinstance(child, Node)):
+                    stack.append(iter(sorted(child.contents, key=lambda x:x.name())))
+                    break
+                id = self._updateLeaf(child, progress)
+                if (not (id is None)):
+                    seen.append(id)
+                    last = child.path()
+                if (len(seen) >= self.SWEEP_BATCH):
+                    self.__stampBatch(seen, progress, last)
+                    seen = []
+                if (not (progress is None) and time.time() - lastProgress >= self.PROGRESS_INTERVAL):
+                    self._sendProgress(progress)
+                    lastProgress = time.time()
+            else:
+                stack.pop()
+        self.__stampBatch(seen, progress, last)
+
+    def __stampBatch(self, ids, progress, last):
+        """Stamps a batch of entries and commits them along with the scan checkpoint"""
+        self._stampEntries(ids)
+        if (not (progress is None or last is None)):
+            self.setMeta('scan_checkpoint', last)
+        self.__db.commitBatch()
+
+    def _updateLeaf(self, leaf, progress=None):
+        """Brings the entry for leaf up to date and returns its id, or None if it isn't in this shard
+
+        If given, progress counts whether the leaf was indexed or skipped.
+        """
+        hash = hashlib.sha1(leaf.path()).hexdigest()
+        if (not self._ownsHash(hash)):
+            return None
+        obj = self._findLeafByPathHash(hash)
+        realPath = self._leafRealPath(leaf)
+        (size, mtime, contentId) = (None, None, None)
+        if (not (realPath is None)):
+            try:
+                st = os.stat(realPath)
+                (size, mtime) = (st.st_size, st.st_mtime)
+            except OSError, e:
+                pass
+        if (not (obj is None or size is None) and obj['realpath'] == realPath and
+                obj['size'] == size and obj['mtime'] == mtime):
+            #Unchanged since it was last read
+            if (not (progress is None)):
+                progress.skipped += 1
+            return obj['id']
+        if (not (progress is None)):
+            progress.indexed += 1
+        if (not (size is None)):
+            try:
+                contentId = modulation.util.contentId(realPath, size)
+            except IOError, e:
+                pass
+        if (obj is None and not (contentId is None)):
+            id = self._relinkLeaf(leaf, hash, realPath, contentId, size, mtime)
+            if (not (id is None)):
+                return id
+        #Tags are read before touching the database, so a file that can't be read leaves no half written entry
+        metadata = leaf.media().getMetadata()
+        if (obj is None):
+            obj = self._addLeaf(leaf)
+        with self.__db as db:
+            c = db.cursor()
+            c.execute("UPDATE entries SET realpath = ?, contentid = ?, size = ?, mtime = ? WHERE id = ?",
+                (realPath, contentId, size, mtime, obj['id']))
+            c.execute("DELETE FROM metadata WHERE entryid = ?", (obj['id'],))
+            for key, value in metadata.iteritems():
+                c.execute("INSERT OR REPLACE INTO metadata (entryid, name, value, numvalue) VALUES (?,?,?,?)", (obj['id'], key, value, modulation.media.numericValue(key, value)))
+            if (self.__compiler.fulltext()):
+                c.execute("DELETE FROM fulltext WHERE rowid = ?", (obj['id'],))
+                c.execute("INSERT INTO fulltext (rowid, %s) VALUES (?, %s)"%(', '.join(FULLTEXT_KEYS), ', '.join('?'*len(FULLTEXT_KEYS))),
+                    (obj['id'],)+tuple([metadata.get(key) for key in FULLTEXT_KEYS]))
+            db.commit()
+            c.close()
+        return obj['id']
+
+    def _removeNode(self, node):
         for child in node.contents:
             if (isinstance(child, Leaf)):
-                self._updateLeaf(child)
+                self._removeLeaf(child)
             else:
-                self._updateNode(child)
+                self._removeNode(child)
 
-    def _updateLeaf(self, leaf):
-        media = leaf.media()
+    #How many live entries with the same contents _relinkLeaf() checks for a missing file
+    RELINK_CANDIDATES = 8
+
+    def _relinkLeaf(self, leaf, hash, realPath, contentId, size, mtime):
+        """Points an entry for the same contents at leaf, if its file has gone
+
+        The entry keeps its id and metadata, so the file's tags don't need to
+        be read again. Orphans are tried first, then up to RELINK_CANDIDATES
+        entries that the current scan hasn't seen yet. Returns the entry's
+        id, or None if there wasn't one.
+        """
+        pathid = self._getPathId('/'.join(leaf.path().split('/')[:-1]))
+        with self.__db as db:
+            c = db.cursor()
+            c.execute("SELECT entryid FROM orphans WHERE contentid = ? LIMIT 1", (contentId,))
+            orphan = c.fetchone()
+            if (not (orphan is None)):
+                id = orphan['entryid']
+                c.execute("DELETE FROM orphans WHERE entryid = ?", (id,))
+                c.execute("INSERT INTO entries (id, pathid, name, path_sha1, realpath, contentid, size, mtime) VALUES (?,?,?,?,?,?,?,?)",
+                    (id, pathid, leaf.name(), hash, realPath, contentId, size, mtime))
+                if (self.__compiler.fulltext()):
+                    c.execute("INSERT INTO fulltext (rowid, %s) SELECT ?, %s"%(', '.join(FULLTEXT_KEYS),
+                        ', '.join(["(SELECT value FROM metadata WHERE entryid = ? AND name = '%s')"%(key) for key in FULLTEXT_KEYS])),
+                        (id,)*(len(FULLTEXT_KEYS)+1))
+            else:
+                #Entries this scan has already stamped are still there, and many copies
+                #of the same file shouldn't cost a stat() each for every new one
+                c.execute("SELECT id, realpath FROM entries WHERE contentid = ? AND coalesce(scan, 0) != ? LIMIT ?",
+                    (contentId, self.__scan, self.RELINK_CANDIDATES))
+                for row in c.fetchall():
+                    if (not (row['realpath'] is None) and not os.path.exists(row['realpath'])):
+                        id = row['id']
+                        c.execute("UPDATE entries SET pathid = ?, name = ?, path_sha1 = ?, realpath = ?, size = ?, mtime = ? WHERE id = ?",
+                            (pathid, leaf.name(), hash, realPath, size, mtime, id))
+                        break
+                else:
+                    c.close()
+                    return None
+            db.commit()
+            c.close()
+        self._log.debug("Relinked entry %i to %s", id, realPath)
+        return id
+
+    def _removeLeaf(self, leaf):
         obj = self._findLeafByPathHash(hashlib.sha1(leaf.path()).hexdigest())
         if (obj is None):
-            obj = self._addLeaf(leaf)
+            return
         with self.__db as db:
             c = db.cursor()
-            for key, value in media.getMetadata().iteritems():
-                c.execute("INSERT OR REPLACE INTO metadata (entryid, name, value) VALUES (?,?,?)", (obj['id'], key, value))
+            if (obj['contentid'] is None):
+                c.execute("DELETE FROM metadata WHERE entryid = ?", (obj['id'],))
+            else:
+                c.execute("INSERT OR REPLACE INTO orphans (entryid, contentid, removed) VALUES (?,?,?)", (obj['id'], obj['contentid'], time.time()))
+            c.execute("DELETE FROM entries WHERE id = ?", (obj['id'],))
+            if (self.__compiler.fulltext()):
+                c.execute("DELETE FROM fulltext WHERE rowid = ?", (obj['id'],))
             db.commit()
             c.close()
 
@@ -341,11 +1270,20 @@ class DBCache(Node):
             c = db.cursor()
             hash = hashlib.sha1(leaf.path()).hexdigest()
             path = self._getPathId('/'.join(leaf.path().split('/')[:-1]))
-            c.execute("INSERT INTO entries (pathid, name, path_sha1) VALUES (?,?,?)", (path, leaf.name(), hash))
+            #Ids of orphaned entries must not be handed out again
+            c.execute("INSERT INTO entries (id, pathid, name, path_sha1, realpath) VALUES "
+                "(max(coalesce((SELECT max(id) FROM entries), 0), coalesce((SELECT max(entryid) FROM orphans), 0))+1, ?,?,?,?)",
+                (path, leaf.name(), hash, self._leafRealPath(leaf)))
             db.commit()
             c.close()
             return self._findLeafByPathHash(hash)
 
+    def _leafRealPath(self, leaf):
+        """Returns the path a FileObject for leaf would be built from, or None"""
+        if (isinstance(leaf, File)):
+            return leaf.realPath()
+        return None
+
     def _getPathId(self, path, parent = 0):
         component = path.split('/')[0]
         with self.__db as db:
@@ -359,6 +1297,24 @@ class DBCache(Node):
                 return node['id']
             return self._getPathId('/'.join(path.split('/')[1:]), node['id'])
 
+    def _lookupPathId(self, path):
+        """Returns the id of a collection path like /Jazz/Live, or None if it isn't in the database"""
+        components = ['']
+        if (path.strip('/') != ''):
+            components.extend(path.strip('/').split('/'))
+        id = 0
+        with self.__db as db:
+            c = db.cursor()
+            for component in components:
+                c.execute("SELECT id FROM paths WHERE parent=? AND name=?", (id, component))
+                node = c.fetchone()
+                if (node is None):
+                    c.close()
+                    return None
+                id = node['id']
+            c.close()
+        return id
+
     def _getPathById(self, id):
         with self.__db as db:
             c = db.cursor()
@@ -371,64 +1327,1265 @@ class DBCache(Node):
         with self.__db as db:
             c = db.cursor()
             c.execute("INSERT INTO paths (parent, name) VALUES (?,?)", (parent, name))
+            id = c.lastrowid
+            c.execute("INSERT INTO path_closure (ancestor, descendant, depth) "
+                "SELECT ancestor, ?, depth+1 FROM path_closure WHERE descendant = ? UNION ALL SELECT ?, ?, 0",
+                (id, parent, id, id))
             db.commit()
             c.close()
-            return self._getPathById(c.lastrowid)
+            return self._getPathById(id)
+
+class ShardReader(threading.Thread):
+    """Reads rows from a shard in the background, a page ahead of whoever is iterating over it"""
+    def __init__(self, rows, pageSize):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.__rows = rows
+        self.__pageSize = pageSize
+        self.__pages = Queue(2)
+        self.__stopped = threading.Event()
+
+    def run(self):
+        page = []
+        try:
+            for row in self.__rows:
+                page.append(row)
+                if (len(page) == self.__pageSize):
+                    if (not self.__put(page)):
+                        return
+                    page = []
+            self.__put(page)
+            self.__put(None)
+        except Exception, e:
+            self.__put(e)
+
+    def __put(self, item):
+        while (not self.__stopped.isSet()):
+            try:
+                self.__pages.put(item, True, 0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def stop(self):
+        """Tells the reader to give up on the rest of the rows"""
+        self.__stopped.set()
+
+    def __iter__(self):
+        while True:
+            page = self.__pages.get()
+            if (page is None):
+                return
+            if (isinstance(page, Exception)):
+                raise page
+            for row in page:
+                yield row
+
+class ShardedDBCache(Node):
+    """A DBCache split across several database files by path hash
+
+    Each shard is a DBCache that only stores the leaves whose path hashes to
+    it, so indexing writes to every shard at once and each shard has its own
+    lock. Queries run against every shard in parallel and the results are
+    merged: path ordered results are merged in order, and random results are
+    drawn from each shard in proportion to how many matches it has, so every
+    match is equally likely to be picked.
+
+    The shard files are named after path, with the shard number before the
+    extension. The number of shards can't be changed once they exist.
+    """
+    def __init__(self, path, backend, shards=4, incrementalVacuum=False):
+        super(ShardedDBCache, self).__init__('', None)
+        (root, ext) = os.path.splitext(path)
+        self.__backend = backend
+        self.__shards = [DBCache("%s.%i%s"%(root, i, ext), backend, i, shards, incrementalVacuum) for i in range(shards)]
+        self.__queryStats = QueryStats()
+        self.__progress = [None]*shards
+        self.__progressLock = threading.Lock()
+        self.__progressListeners = []
+        for (i, shard) in enumerate(self.__shards):
+            shard.addProgressListener(lambda packet, i=i:self.__shardProgress(i, packet))
+        stamps = [shard.getMeta('last_update') for shard in self.__shards]
+        if (None in stamps):
+            self.setLastUpdateTime(None)
+        else:
+            self.setLastUpdateTime(min([float(x) for x in stamps]))
+
+    def shards(self):
+        return tuple(self.__shards)
+
+    def generation(self):
+        return super(ShardedDBCache, self).generation() + sum([shard.generation() for shard in self.__shards])
+
+    def update(self):
+        """Rescans the backend and updates every shard, blocking until they are done"""
+        self._updateBackend()
+
+    def _updateBackend(self):
+        self.__backend.update()
+        threads = [threading.Thread(target=shard._indexBackend) for shard in self.__shards]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._newGeneration()
+
+    def countMatches(self, constraint):
+        """Returns how many entries match constraint across every shard"""
+        return sum(self.__parallel(lambda shard:shard.countMatches(constraint)))
+
+    def __parallel(self, func):
+        """Returns [func(shard) for each shard], calling it for every shard at once"""
+        results = [None]*len(self.__shards)
+        errors = []
+        def run(index, shard):
+            try:
+                results[index] = func(shard)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(i, shard)) for (i, shard) in enumerate(self.__shards)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if (len(errors) > 0):
+            raise errors[0]
+        return results
+
+    def addProgressListener(self, callback):
+        """Registers callback(packet) to be given a ScanProgressPacket covering every shard as scans go on"""
+        self.__progressListeners.append(callback)
+
+    def removeProgressListener(self, callback):
+        self.__progressListeners.remove(callback)
+
+    def __shardProgress(self, index, packet):
+        with self.__progressLock:
+            self.__progress[index] = packet
+            packets = [p for p in self.__progress if not (p is None)]
+            if (len(packets) < len(self.__shards)):
+                return
+            etas = [p.eta for p in packets]
+            eta = None
+            if (not (None in etas)):
+                eta = max(etas)
+            done = min([p.done for p in packets])
+            total = ScanProgressPacket(self, sum([p.seen for p in packets]), sum([p.indexed for p in packets]),
+                sum([p.skipped for p in packets]), sum([p.total for p in packets]), sum([p.rate for p in packets]),
+                eta, done)
+            if (done):
+                self.__progress = [None]*len(self.__shards)
+        for callback in list(self.__progressListeners):
+            try:
+                callback(total)
+            except Exception, e:
+                self._log.error("Exception caught from progress listener %s: %s", callback, e)
+
+    def queryStats(self):
+        """Returns the QueryStats.stats() of the queries run across every shard
+
+        Each shard keeps its own stats, and logs its own slow queries.
+        """
+        return self.__queryStats.stats()
+
+    def setSlowQueryThreshold(self, seconds):
+        for shard in self.__shards:
+            shard.setSlowQueryThreshold(seconds)
+
+    def findMedia(self, constraint, limit=0, order=modulation.query.ORDER_RANDOM):
+        return tuple(self.iterMedia(constraint, limit, order))
+
+    def iterMedia(self, constraint, limit=0, order=modulation.query.ORDER_RANDOM):
+        """Yields the MediaObjects matching constraint, reading every shard in parallel"""
+        shape = self.__shards[0].queryShape(constraint, order, limit)
+        return self.__queryStats.timed(shape, self.__iterMedia(constraint, limit, order))
+
+    def __iterMedia(self, constraint, limit, order):
+        if (order == modulation.query.ORDER_PATH):
+            readers = [ShardReader(shard._iterRows(constraint, limit, order), DBCache.PAGE_SIZE) for shard in self.__shards]
+            rows = self.__mergePathOrdered(readers)
+        else:
+            counts = self.__parallel(lambda shard:shard.countMatches(constraint))
+            if (limit > 0):
+                #Pick which of the matches to return, then ask each shard for its share
+                counts = drawShares(counts, limit)
+            readers = []
+            for (shard, count) in zip(self.__shards, counts):
+                if (count == 0):
+                    rows = iter(())
+                elif (limit > 0):
+                    rows = shard._iterRows(constraint, count, order)
+                else:
+                    rows = shard._iterRows(constraint, 0, order)
+                readers.append(ShardReader(rows, DBCache.PAGE_SIZE))
+            rows = self.__interleave(readers, counts)
+        for reader in readers:
+            reader.start()
+        count = 0
+        try:
+            for (shard, row) in rows:
+                yield self.__shards[shard]._rowMedia(row)
+                count += 1
+                if (count == limit):
+                    return
+        finally:
+            for reader in readers:
+                reader.stop()
+
+    def __mergePathOrdered(self, readers):
+        iterators = [self.__keyRows(i, reader) for (i, reader) in enumerate(readers)]
+        for (realpath, shard, id, row) in heapq.merge(*iterators):
+            yield (shard, row)
+
+    def __keyRows(self, shard, rows):
+        """Yields rows with the keys a shard sorts them by, for merging"""
+        for row in rows:
+            yield (row['realpath'] or '', shard, row['id'], row)
+
+    def __interleave(self, readers, counts):
+        """Merges shuffled rows from each shard into a single random order
+
+        The next row is taken from each shard with a chance proportional to how
+        many rows it has left, which makes every order equally likely.
+        """
+        readers = [iter(reader) for reader in readers]
+        remaining = list(counts)
+        total = sum(remaining)
+        while (total > 0):
+            pick = random.randrange(total)
+            for (i, count) in enumerate(remaining):
+                if (pick < count):
+                    break
+                pick -= count
+            try:
+                row = readers[i].next()
+            except StopIteration:
+                #The shard changed since it was counted
+                total -= remaining[i]
+                remaining[i] = 0
+                continue
+            remaining[i] -= 1
+            total -= 1
+            yield (i, row)
+
+    def snapshotEntries(self):
+        """Yields (path, realpath, metadata) for every entry in path order, for modulation.snapshot"""
+        iterators = [self.__keyEntries(i, shard.snapshotEntries()) for (i, shard) in enumerate(self.__shards)]
+        for (key, shard, index, entry) in heapq.merge(*iterators):
+            yield entry
+
+    def __keyEntries(self, shard, entries):
+        for (index, entry) in enumerate(entries):
+            yield (entry[1] or '', shard, index, entry)
 
 class Directory(Node):
     """A directory within a DirectoryRoot collection."""
+    __slots__ = ('__realPath',)
+
+    def __init__(self, name, parent=None):
+        super(Directory, self).__init__(name, parent)
+        self.__realPath = None
+
     def update(self):
+        """Rescans this directory and every directory beneath it
+
+        The walk is iterative and lists each directory with a single scandir
+        call, so every entry is stat()ed at most once. Symlinked directories
+        are only walked once every real directory has been, and are skipped if
+        they lead somewhere already visited, such as in a symlink loop, so
+        the real path always wins. Children that are gone are removed and
+        reported to listeners.
+        """
+        now = time.time()
         try:
-            for file in os.listdir(self.realPath()):
-                if (os.path.isfile(self.realPath()+"/"+file)):
-                    if (file not in self):
-                        self.addChild(File(file, self))
-                if (os.path.isdir(self.realPath()+"/"+file)):
-                    if (file not in self):
-                        subdir = Directory(file, self)
-                        subdir.refresh()
-                        if (len(subdir) > 0):
-                            self.addChild(subdir)
-                    else:
-                        self[file].refresh()
+            st = os.stat(self.realPath())
         except OSError, e:
-            pass
+            return
+        seen = set(((st.st_dev, st.st_ino),))
+        added = []
+        stack = [(self, self.realPath(), False)]
+        #Directories reached through a symlink, walked after the real ones
+        aliases = []
+        while (len(stack) > 0 or len(aliases) > 0):
+            (node, path, aliased) = (stack or aliases).pop()
+            try:
+                entries = list(modulation.util.scanDirectory(path))
+            except OSError, e:
+                continue
+            names = set()
+            for entry in entries:
+                try:
+                    isdir = entry.is_dir()
+                    isfile = (not isdir) and entry.is_file()
+                except OSError, e:
+                    continue
+                if (isfile):
+                    names.add(entry.name)
+                    if (entry.name in node and isinstance(node[entry.name], Directory)):
+                        node._notify(REMOVED, node.removeChild(entry.name))
+                    if (entry.name not in node):
+                        node.addChild(File(entry.name, node))
+                elif (isdir):
+                    try:
+                        st = entry.stat()
+                        alias = aliased or entry.is_symlink()
+                    except OSError, e:
+                        continue
+                    if (alias and (st.st_dev, st.st_ino) in seen):
+                        self._log.debug("Skipping already visited directory %s", entry.path)
+                        continue
+                    seen.add((st.st_dev, st.st_ino))
+                    names.add(entry.name)
+                    if (entry.name in node and isinstance(node[entry.name], Directory)):
+                        subdir = node[entry.name]
+                    else:
+                        if (entry.name in node):
+                            node._notify(REMOVED, node.removeChild(entry.name))
+                        subdir = Directory(entry.name, node)
+                        added.append((node, subdir))
+                    if (alias):
+                        aliases.append((subdir, entry.path, True))
+                    else:
+                        stack.append((subdir, entry.path, False))
+            for child in node.contents:
+                if (not child.name() in names):
+                    node._notify(REMOVED, node.removeChild(child.name()))
+            node.setLastUpdateTime(now)
+        #Newly found directories are only attached once they turn out to have contents
+        for (parent, subdir) in reversed(added):
+            if (len(subdir) > 0):
+                parent.addChild(subdir)
 
     def realPath(self):
-        return '/'.join((self.parent().realPath(), self.name()))
+        if (self.__realPath is None):
+            self.__realPath = '/'.join((self.parent().realPath(), self.name()))
+        return self.__realPath
 
 class DirectoryRoot(Directory):
-    """The root directory of a filesystem collection"""
-    def __init__(self, path, parent = None):
+    """The root directory of a filesystem collection
+
+    If watch is true, changes on disk are applied to the tree as they happen
+    using inotify, and the periodic full rescan is only used as a fallback.
+    If indexed is true, the metadata of every file is kept in memory so
+    queries don't have to read each file's tags.
+    """
+    def __init__(self, path, parent = None, watch = False, indexed = False):
         super(DirectoryRoot, self).__init__('', None)
         self.__path = path
+        self.__watcher = None
         self.update()
+        if (indexed):
+            self.setIndexed(True)
+        if (watch):
+            self.watch()
+
+    def realPath(self):
+        return self.__path
+
+    def watch(self):
+        """Starts applying filesystem changes to the tree as they happen"""
+        if (self.__watcher is None):
+            self.__watcher = DirectoryWatcher(self)
+            self.__watcher.start()
+
+    def unwatch(self):
+        """Stops watching the filesystem for changes"""
+        if (not (self.__watcher is None)):
+            self.__watcher.stop()
+            self.__watcher = None
+
+    def isWatched(self):
+        """Returns true if filesystem changes are being applied as they happen"""
+        return (not (self.__watcher is None)) and self.__watcher.isAlive()
+
+    def revalidate(self):
+        if (self.isWatched()):
+            return
+        super(DirectoryRoot, self).revalidate()
+
+    def findDirectory(self, path, create=False):
+        """Returns the Directory for a real path within this root
+
+        Missing directories along the way are created and attached if create
+        is true, otherwise None is returned.
+        """
+        node = self
+        if (path == self.__path):
+            return node
+        for component in path[len(self.__path)+1:].split('/'):
+            if (component in node):
+                node = node[component]
+            elif (create):
+                child = Directory(component, node)
+                node.addChild(child)
+                node = child
+            else:
+                return None
+        return node
+
+class LazyDirectory(Directory):
+    """A directory that is only listed once something asks for its children
+
+    It belongs to a LazyDirectoryRoot, which may unload it again once it
+    hasn't been used for a while and the tree is over its memory budget.
+    Subdirectories are listed whether or not they have any files, and
+    symlinks back to a directory above are left out.
+    """
+    __slots__ = ('__loaded', '__root')
+
+    def __init__(self, name, parent=None, root=None):
+        super(LazyDirectory, self).__init__(name, parent)
+        self.__loaded = False
+        if (root is None):
+            root = self
+        self.__root = root
+
+    def isLoaded(self):
+        """Returns true if this directory's children are in memory"""
+        return self.__loaded
+
+    def _load(self):
+        """Lists this directory, unless it already has been"""
+        root = self.__root
+        if (self.__loaded):
+            root._touch(self)
+            return
+        path = self.realPath()
+        children = []
+        try:
+            entries = list(modulation.util.scanDirectory(path))
+        except OSError, e:
+            self._log.warn("Could not list %s: %s", path, e)
+            entries = []
+        for entry in entries:
+            try:
+                isdir = entry.is_dir()
+                isfile = (not isdir) and entry.is_file()
+                if (isdir and entry.is_symlink()):
+                    target = os.path.realpath(entry.path)
+                    here = os.path.realpath(path)
+                    if (here == target or here.startswith(target.rstrip('/')+'/')):
+                        self._log.debug("Skipping symlink loop %s", entry.path)
+                        continue
+            except OSError, e:
+                continue
+            if (isfile):
+                children.append(File(entry.name, self))
+            elif (isdir):
+                children.append(LazyDirectory(entry.name, self, root))
+        with root._lock:
+            if (self.__loaded):
+                return
+            for child in children:
+                super(LazyDirectory, self).addChild(child)
+            self.__loaded = True
+        root._loaded(self, len(children))
+
+    def _unload(self, recursive=False):
+        """Forgets this directory's children, so they are listed again when next used
+
+        Unless recursive is true, subdirectories that are still listed are
+        only detached from the tree. Anyone walking them can carry on, and they
+        are unloaded in turn once they have gone unused for long enough.
+        """
+        if (not self.__loaded):
+            return
+        for child in super(LazyDirectory, self).contents:
+            if (recursive and isinstance(child, LazyDirectory)):
+                self.__root._forget(child)
+                child._unload(True)
+            super(LazyDirectory, self).removeChild(child.name())
+        self.__loaded = False
+
+    @property
+    def contents(self):
+        self._load()
+        return super(LazyDirectory, self).contents
+
+    def __getitem__(self, key):
+        self._load()
+        return super(LazyDirectory, self).__getitem__(key)
+
+    def __contains__(self, key):
+        self._load()
+        return super(LazyDirectory, self).__contains__(key)
+
+    def __len__(self):
+        self._load()
+        return super(LazyDirectory, self).__len__()
+
+    def update(self):
+        """Forgets what has been listed beneath this directory, so it is listed afresh when next used"""
+        with self.__root._lock:
+            self._unload(True)
+            if (not (self is self.__root)):
+                self.__root._forget(self)
+
+class LazyDirectoryRoot(LazyDirectory):
+    """The root directory of a filesystem collection that is listed as it is used
+
+    Opening one doesn't touch the disk, which suits huge or slow network
+    mounts where only part of the tree is ever queried. If memoryBudget is
+    given, the directories used longest ago are unloaded whenever the listed
+    children are estimated to take more than that many bytes. The root's own
+    listing is never unloaded.
+    """
+    #Rough number of bytes a listed child takes, for the memory budget
+    ENTRY_SIZE = 200
+
+    def __init__(self, path, memoryBudget=None):
+        super(LazyDirectoryRoot, self).__init__('', None)
+        self.__path = path
+        self._lock = threading.RLock()
+        self.__listings = None
+        if (not (memoryBudget is None)):
+            self.__listings = modulation.util.LRUCache(memoryBudget, lambda count:count*self.ENTRY_SIZE, self.__evicted)
+        self.loads = 0
+        self.evictions = 0
 
     def realPath(self):
         return self.__path
 
+    def memoryUsage(self):
+        """Returns the estimated bytes taken by the listings that count against the budget"""
+        if (self.__listings is None):
+            return None
+        return self.__listings.cost()
+
+    def _touch(self, directory):
+        if (not (self.__listings is None or directory is self)):
+            self.__listings.get(directory)
+
+    def _loaded(self, directory, count):
+        self.loads += 1
+        if (not (self.__listings is None or directory is self)):
+            self.__listings.put(directory, count)
+
+    def _forget(self, directory):
+        if (not (self.__listings is None)):
+            self.__listings.discard(directory)
+
+    def __evicted(self, directory, count):
+        with self._lock:
+            self._log.debug("Unloading %s", directory.realPath())
+            self.evictions += 1
+            directory._unload()
+
+class DirectoryWatcher(threading.Thread):
+    """Applies inotify events to a DirectoryRoot and tells its listeners"""
+    MASK = (modulation.inotify.IN_CREATE | modulation.inotify.IN_DELETE |
+            modulation.inotify.IN_MOVED_FROM | modulation.inotify.IN_MOVED_TO |
+            modulation.inotify.IN_CLOSE_WRITE | modulation.inotify.IN_ONLYDIR)
+
+    def __init__(self, root):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._log = logging.getLogger("modulation.collection.%s"%(self.__class__.__name__))
+        self.__root = root
+        self.__inotify = modulation.inotify.Inotify()
+        self.__watches = {}
+        self.__running = True
+        self.watchTree(root.realPath())
+
+    def stop(self):
+        """Asks the watcher thread to exit"""
+        self.__running = False
+
+    def watchTree(self, path):
+        """Adds watches for path and every directory beneath it"""
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            try:
+                self.__watches[self.__inotify.addWatch(dirpath, self.MASK)] = dirpath
+            except OSError, e:
+                self._log.warn("Could not watch %s: %s", dirpath, e)
+
+    def unwatchTree(self, path):
+        """Removes the watches for path and every directory beneath it"""
+        for (wd, watched) in self.__watches.items():
+            if (watched == path or watched.startswith(path+"/")):
+                del self.__watches[wd]
+                try:
+                    self.__inotify.removeWatch(wd)
+                except OSError, e:
+                    pass
+
+    def run(self):
+        try:
+            while (self.__running):
+                for event in self.__inotify.read(1.0):
+                    try:
+                        self.handleEvent(event)
+                    except Exception, e:
+                        self._log.error("Exception caught handling %r: %s", event, e)
+        finally:
+            self.__inotify.close()
+
+    def handleEvent(self, event):
+        """Applies a single inotify event to the tree"""
+        if (event.mask & modulation.inotify.IN_Q_OVERFLOW):
+            self._log.warn("Event queue overflowed, rescanning %s", self.__root.realPath())
+            self.unwatchTree(self.__root.realPath())
+            self.watchTree(self.__root.realPath())
+            self.__root.update()
+            self.__root.setLastUpdateTime(time.time())
+            self.__root._notify(RESCANNED, self.__root)
+            return
+        if (event.mask & modulation.inotify.IN_IGNORED):
+            self.__watches.pop(event.wd, None)
+            return
+        if (not event.wd in self.__watches):
+            return
+        dirpath = self.__watches[event.wd]
+        path = '/'.join((dirpath, event.name))
+        if (event.mask & (modulation.inotify.IN_DELETE | modulation.inotify.IN_MOVED_FROM)):
+            if (event.isDir()):
+                self.unwatchTree(path)
+            parent = self.__root.findDirectory(dirpath)
+            if (not (parent is None) and event.name in parent):
+                parent._notify(REMOVED, parent.removeChild(event.name))
+        elif (event.isDir()):
+            self.__addDirectory(dirpath, event.name)
+        elif (event.mask & modulation.inotify.IN_CREATE):
+            #Symlinks and hard links are complete as soon as they appear, so they never get an IN_CLOSE_WRITE
+            try:
+                st = os.lstat(path)
+            except OSError, e:
+                return
+            if (stat.S_ISLNK(st.st_mode) and os.path.isdir(path)):
+                self.__addDirectory(dirpath, event.name)
+            elif (stat.S_ISLNK(st.st_mode) and os.path.isfile(path)):
+                self.__addFile(dirpath, event.name)
+            elif (stat.S_ISREG(st.st_mode) and st.st_nlink > 1):
+                self.__addFile(dirpath, event.name)
+        elif (event.mask & (modulation.inotify.IN_CLOSE_WRITE | modulation.inotify.IN_MOVED_TO)):
+            if (os.path.isdir(path)):
+                #A symlink to a directory
+                self.__addDirectory(dirpath, event.name)
+            else:
+                self.__addFile(dirpath, event.name)
+
+    def __addDirectory(self, dirpath, name):
+        path = '/'.join((dirpath, name))
+        self.watchTree(path)
+        parent = self.__root.findDirectory(dirpath, True)
+        if (not name in parent):
+            subdir = Directory(name, parent)
+            subdir.update()
+            if (len(subdir) > 0):
+                parent.addChild(subdir)
+                parent._notify(ADDED, subdir)
+
+    def __addFile(self, dirpath, name):
+        parent = self.__root.findDirectory(dirpath, True)
+        if (name in parent):
+            parent._notify(MODIFIED, parent[name])
+        else:
+            leaf = File(name, parent)
+            parent.addChild(leaf)
+            parent._notify(ADDED, leaf)
+
+class QueryCache(object):
+    """Remembers query results until a collection they came from changes
+
+    Results are keyed by the canonical form of the constraint along with the
+    limit and order, and are only handed out while the generations of the
+    collections match the ones they were stored with. Whole match sets can be
+    stored as well, so random queries can be answered by sampling from them.
+    Constraints whose match sets turned out too big to store are remembered
+    until a collection moves on, so they keep being sampled instead of being
+    fetched whole again.
+    """
+    #Rough number of bytes a cached MediaObject costs
+    MEDIA_SIZE = 256
+
+    def __init__(self, maxBytes=16*1024*1024):
+        super(QueryCache, self).__init__()
+        self.__maxBytes = maxBytes
+        self.__results = modulation.util.LRUCache(maxBytes, self.__cost)
+        #Constraints that were recently sampled without a cached match set
+        self.__sampled = modulation.util.LRUCache(1024)
+        #Constraints that matched more media than fit in the cache, with the generations they did at
+        self.__tooLarge = modulation.util.LRUCache(1024)
+
+    def __cost(self, value):
+        (generations, results) = value
+        return (len(results)+1)*self.MEDIA_SIZE
+
+    def get(self, key, generations):
+        """Returns the stored results for key, or None if there are none or they are stale"""
+        value = self.__results.get(key)
+        if (value is None):
+            return None
+        if (value[0] != generations):
+            self.__results.discard(key)
+            return None
+        return value[1]
+
+    def put(self, key, generations, results):
+        """Stores results for key, along with the collection generations they came from"""
+        self.__results.put(key, (generations, tuple(results)))
+
+    def getMatches(self, constraint, generations):
+        """Returns every media matching constraint, if they are stored"""
+        return self.get((constraint, 0, None), generations)
+
+    def putMatches(self, constraint, generations, results):
+        """Stores every media matching constraint, or remembers that they don't fit"""
+        if ((len(results)+1)*self.MEDIA_SIZE > self.__maxBytes):
+            self.__tooLarge.put(constraint, generations)
+            return
+        self.__tooLarge.discard(constraint)
+        self.put((constraint, 0, None), generations, results)
+
+    def sampled(self, constraint, generations):
+        """Records a random sample of constraint and returns true if it was sampled recently
+
+        Constraints whose match sets didn't fit in the cache at these
+        generations never count as sampled recently.
+        """
+        if (self.__tooLarge.get(constraint) == generations):
+            return False
+        if (constraint in self.__sampled):
+            self.__sampled.discard(constraint)
+            return True
+        self.__sampled.put(constraint, True)
+        return False
+
+    def hits(self):
+        return self.__results.hits
+
+    def misses(self):
+        return self.__results.misses
+
+class QueryCursor(object):
+    """The remaining results of a paged query"""
+    def __init__(self, results, pageSize):
+        super(QueryCursor, self).__init__()
+        self.__results = results
+        self.__pageSize = pageSize
+        self.__pending = None
+        self.lastUsed = time.time()
+
+    def nextPage(self):
+        """Returns the next page of results, and whether there are more after it"""
+        self.lastUsed = time.time()
+        page = []
+        if (not (self.__pending is None)):
+            page.append(self.__pending)
+            self.__pending = None
+        page.extend(itertools.islice(self.__results, self.__pageSize-len(page)))
+        #Look ahead by one, so the last page doesn't need a token
+        for media in self.__results:
+            self.__pending = media
+            break
+        return (tuple(page), not (self.__pending is None))
+
+class RandomShares(object):
+    """Splits a random query's limit between collections in proportion to their matches
+
+    Collections that can count their matches report the count, then wait()
+    for their share, which is drawn once every collection has been counted.
+    The others are weighted by how many results they returned.
+    """
+    def __init__(self, limit):
+        super(RandomShares, self).__init__()
+        self.__limit = limit
+        self.__shares = {}
+        self.__drawn = threading.Event()
+
+    def draw(self, counts):
+        """Draws the shares, given a dict of each collection's match count"""
+        collections = counts.keys()
+        self.__shares = dict(zip(collections, drawShares([counts[c] for c in collections], self.__limit)))
+        self.__drawn.set()
+
+    def abandon(self):
+        """Lets any collection still waiting for its share go without one"""
+        self.__drawn.set()
+
+    def drawn(self):
+        return self.__drawn.isSet()
+
+    def share(self, collection):
+        """Returns how many results collection is to return"""
+        return self.__shares.get(collection, 0)
+
+    def wait(self, collection):
+        """Waits for the shares to be drawn, and returns collection's"""
+        self.__drawn.wait()
+        return self.share(collection)
+
+class SearchPool(object):
+    """A few reusable threads that run one collection's searches
+
+    Threads are started as searches come in, up to size of them, and then
+    wait for more work. A collection that hangs can only tie up its own
+    pool.
+    """
+    def __init__(self, size):
+        super(SearchPool, self).__init__()
+        self.__size = size
+        self.__jobs = Queue()
+        self.__lock = threading.Lock()
+        self.__threads = []
+        self.__idle = 0
+
+    def submit(self, func, *args):
+        """Runs func(*args) on one of the pool's threads"""
+        with self.__lock:
+            if (self.__idle > 0):
+                self.__idle -= 1
+            elif (len(self.__threads) < self.__size):
+                worker = threading.Thread(target=self.__work)
+                worker.daemon = True
+                self.__threads.append(worker)
+                worker.start()
+            self.__jobs.put((func, args))
+
+    def __work(self):
+        while True:
+            job = self.__jobs.get()
+            if (job is None):
+                return
+            (func, args) = job
+            try:
+                func(*args)
+            except Exception, e:
+                logging.getLogger("modulation.collection.SearchPool").error("Exception caught from search: %s", e)
+            with self.__lock:
+                self.__idle += 1
+
+    def stop(self):
+        """Lets the pool's threads exit once they are done with their current search"""
+        with self.__lock:
+            for worker in self.__threads:
+                self.__jobs.put(None)
+            self.__threads = []
+            self.__idle = 0
+
+class RefreshScheduler(threading.Thread):
+    """Revalidates collections in the background once their refresh interval is up
+
+    Queries keep being answered from whatever the collections hold while they
+    are revalidated. Each collection is revalidated by at most one thread at a
+    time, and a slow collection doesn't hold up the others. If given, onError
+    is called with the collection and the exception when a revalidation fails.
+    """
+    IDLE = "idle"
+    SCANNING = "scanning"
+
+    def __init__(self, onError=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._log = logging.getLogger("modulation.collection.%s"%(self.__class__.__name__))
+        self.__onError = onError
+        self.__collections = {}
+        self.__wakeup = threading.Condition()
+        self.__running = True
+
+    def add(self, collection, interval=None):
+        """Schedules a collection to be revalidated every interval seconds
+
+        interval defaults to the collection's REFRESH_INTERVAL.
+        """
+        if (interval is None):
+            interval = collection.REFRESH_INTERVAL
+        with self.__wakeup:
+            self.__collections[collection] = {
+                'state': self.IDLE,
+                'interval': interval,
+                'lastUpdate': collection.lastUpdateTime(),
+                'lastDuration': None,
+                'lastError': None,
+                'scans': 0,
+            }
+            self.__wakeup.notify()
+
+    def remove(self, collection):
+        with self.__wakeup:
+            self.__collections.pop(collection, None)
+
+    def setInterval(self, collection, interval):
+        """Changes how often a collection is revalidated"""
+        with self.__wakeup:
+            self.__collections[collection]['interval'] = interval
+            self.__wakeup.notify()
+
+    def state(self, collection):
+        """Returns a dict describing a collection's revalidations
+
+        'state' is IDLE or SCANNING, 'lastUpdate' is when the last revalidation
+        finished, 'lastDuration' is how many seconds it took, and 'nextUpdate'
+        is when the next one is due.
+        """
+        with self.__wakeup:
+            ret = dict(self.__collections[collection])
+        ret['nextUpdate'] = ret['lastUpdate'] + ret['interval']
+        return ret
+
+    def revalidate(self, collection):
+        """Starts revalidating a collection now, unless it already is"""
+        with self.__wakeup:
+            self.__start(collection)
+
+    def stop(self):
+        with self.__wakeup:
+            self.__running = False
+            self.__wakeup.notify()
+
+    def run(self):
+        with self.__wakeup:
+            while (self.__running):
+                now = time.time()
+                wait = None
+                for (collection, info) in self.__collections.items():
+                    if (info['state'] != self.IDLE):
+                        continue
+                    due = info['lastUpdate'] + info['interval'] - now
+                    if (due <= 0):
+                        self.__start(collection)
+                    elif (wait is None or due < wait):
+                        wait = due
+                self.__wakeup.wait(wait)
+
+    def __start(self, collection):
+        info = self.__collections.get(collection)
+        if (info is None or info['state'] != self.IDLE):
+            return
+        info['state'] = self.SCANNING
+        worker = threading.Thread(target=self.__revalidate, args=(collection,))
+        worker.daemon = True
+        worker.start()
+
+    def __revalidate(self, collection):
+        self._log.debug("Revalidating %s", collection)
+        start = time.time()
+        error = None
+        try:
+            collection.revalidate()
+        except Exception, e:
+            self._log.error("Exception caught revalidating %s: %s", collection, e)
+            error = e
+        with self.__wakeup:
+            info = self.__collections.get(collection)
+            if (not (info is None)):
+                info['state'] = self.IDLE
+                info['lastUpdate'] = time.time()
+                info['lastDuration'] = info['lastUpdate'] - start
+                info['lastError'] = error
+                info['scans'] += 1
+            self.__wakeup.notify()
+        if (not (error is None) and not (self.__onError is None)):
+            self.__onError(collection, error)
+
 class CollectionManager(modulation.media.MediaSource):
-    """A collection manager responds to queries and returns lists of media from the underlying collections"""
-    def __init__(self):
+    """A collection manager responds to queries and returns lists of media from the underlying collections
+
+    Results are cached in a QueryCache until one of the collections moves on
+    to a new generation. Identical QueryPackets that are waiting in the queue
+    together are answered with a single search, and random ones share one
+    larger sample between them.
+    """
+    #Seconds a paged query is kept around without being continued
+    CURSOR_TIMEOUT = 300
+    #How many results a collection hands back to findMedia() at a time
+    CHUNK_SIZE = 100
+    #How many searches each collection runs at once
+    SEARCH_THREADS = 4
+
+    def __init__(self, cacheSize=16*1024*1024):
         super(CollectionManager, self).__init__()
         self.__collections = []
-    def addCollection(self, collection):
+        self.__timeouts = {}
+        self.__stats = {}
+        self.__pools = {}
+        self.__cache = QueryCache(cacheSize)
+        self.__cursors = {}
+        self.__scheduler = RefreshScheduler(self.__refreshFailed)
+        self.__scheduler.start()
+
+    def addCollection(self, collection, timeout=None, refreshInterval=None):
+        """Adds a collection to search
+
+        If timeout is given, findMedia() waits at most that many seconds for the
+        collection's results before going on without them. The collection is
+        revalidated in the background every refreshInterval seconds, or its
+        REFRESH_INTERVAL if not given. If the collection reports scan progress,
+        its ScanProgressPackets are sent on.
+        """
         self.__collections.append(collection)
-    def findMedia(self, constraint, limit):
-        ret = ()
+        self.__timeouts[collection] = timeout
+        self.__stats[collection] = {'queries': 0, 'latency': None, 'timeouts': 0, 'errors': 0}
+        self.__pools[collection] = SearchPool(self.SEARCH_THREADS)
+        if (hasattr(collection, 'addProgressListener')):
+            collection.addProgressListener(self.send)
+        self.__scheduler.add(collection, refreshInterval)
+
+    def scheduler(self):
+        """Returns the RefreshScheduler that keeps the collections up to date"""
+        return self.__scheduler
+
+    def collectionStats(self):
+        """Returns a dict of statistics for each collection
+
+        'latency' is how many seconds the last completed query took, while
+        'queries', 'timeouts' and 'errors' count how often each happened.
+        'refresh' is the collection's RefreshScheduler state, and 'shapes' the
+        per-shape query stats of collections that keep them.
+        """
+        ret = {}
+        for (c, stats) in self.__stats.iteritems():
+            ret[c] = dict(stats)
+            ret[c]['refresh'] = self.__scheduler.state(c)
+            if (hasattr(c, 'queryStats')):
+                ret[c]['shapes'] = c.queryStats()
+        return ret
+
+    def _kill(self):
+        super(CollectionManager, self)._kill()
+        self.__scheduler.stop()
+        for pool in self.__pools.itervalues():
+            pool.stop()
+
+    def __refreshFailed(self, collection, error):
+        self.send(modulation.ExceptionPacket(self, error))
+
+    def findMedia(self, constraint, limit, order=modulation.query.ORDER_RANDOM):
+        key = modulation.query.canonical(constraint)
+        if (key is None):
+            return self._findMedia(constraint, limit, order)[0]
+        generations = tuple([c.generation() for c in self.__collections])
+        if (order == modulation.query.ORDER_RANDOM):
+            matches = self.__cache.getMatches(key, generations)
+            if (matches is None and (limit == 0 or self.__cache.sampled(key, generations))):
+                (matches, complete) = self._findMedia(constraint, 0, order)
+                if (complete):
+                    self.__cache.putMatches(key, generations, matches)
+            if (matches is None):
+                return self._findMedia(constraint, limit, order)[0]
+            if (limit == 0 or limit > len(matches)):
+                limit = len(matches)
+            return tuple(random.sample(matches, limit))
+        ret = self.__cache.get((key, limit, order), generations)
+        if (ret is None):
+            (ret, complete) = self._findMedia(constraint, limit, order)
+            if (complete):
+                self.__cache.put((key, limit, order), generations, ret)
+        return ret
+
+    def _findMedia(self, constraint, limit, order):
+        """Queries every collection at once until limit media are found
+
+        Each collection is searched on its SearchPool and given up to its
+        timeout to answer. Once enough results are in, the collections that
+        are still searching are told to stop. A random query's limit is split
+        between the collections by RandomShares in proportion to how many
+        matches each has, so every match is equally likely to be returned
+        whichever collection is fastest. Returns the results, and whether
+        every collection answered.
+        """
+        results = Queue()
+        cancel = threading.Event()
+        found = {}
+        counts = {}
+        shares = None
+        if (order == modulation.query.ORDER_RANDOM and limit > 0):
+            shares = RandomShares(limit)
+        pending = list(self.__collections)
+        start = time.time()
+        for c in self.__collections:
+            found[c] = []
+            self.__pools[c].submit(self._searchCollection, c, constraint, limit, order, results, cancel, shares)
+        try:
+            ret = self.__gather(found, counts, pending, start, limit, order, results, shares)
+        finally:
+            cancel.set()
+            if (not (shares is None)):
+                shares.abandon()
+        return ret
+
+    def __gather(self, found, counts, pending, start, limit, order, results, shares):
+        """Collects the results of _findMedia()'s searches, and returns them and whether they are complete"""
+        complete = True
+        while (len(pending) > 0):
+            if (not (shares is None or shares.drawn()) and len([c for c in pending if not c in counts]) == 0):
+                shares.draw(counts)
+            if (limit > 0 and self._enoughMedia(found, pending, limit, order, shares)):
+                break
+            deadlines = [start+self.__timeouts[c] for c in pending if not (self.__timeouts[c] is None)]
+            wait = None
+            if (len(deadlines) > 0):
+                wait = max(0, min(deadlines)-time.time())
+            try:
+                (c, result, value) = results.get(True, wait)
+            except Empty:
+                for c in list(pending):
+                    if (not (self.__timeouts[c] is None) and time.time() >= start+self.__timeouts[c]):
+                        self._log.warn("Collection backend %s timed out after %.3fs", c, self.__timeouts[c])
+                        self.__stats[c]['timeouts'] += 1
+                        pending.remove(c)
+                        counts.pop(c, None)
+                        complete = False
+                continue
+            if (not c in pending):
+                continue
+            if (result == "count"):
+                counts[c] = value
+            elif (result == "media"):
+                found[c].extend(value)
+            elif (result == "done"):
+                self._log.debug("Collection backend %s answered in %.3fs", c, value)
+                self.__stats[c]['queries'] += 1
+                self.__stats[c]['latency'] = value
+                pending.remove(c)
+                if (not c in counts):
+                    #It couldn't count its matches, so it is weighted by what it returned
+                    counts[c] = len(found[c])
+            else:
+                self._log.error("Exception caught from collection backend %s: %s", c, value)
+                self.send(modulation.ExceptionPacket(self, value))
+                self.__stats[c]['errors'] += 1
+                pending.remove(c)
+                counts.pop(c, None)
+                complete = False
+        if (not (shares is None or shares.drawn())):
+            shares.draw(counts)
+        ret = []
+        for c in self.__collections:
+            if (shares is None):
+                ret.extend(found[c])
+            else:
+                ret.extend(found[c][:shares.share(c)])
+        if (not (shares is None)):
+            #Each collection's share is random, but they still need mixing together
+            random.shuffle(ret)
+        elif (limit > 0 and len(ret) > limit):
+            ret = ret[:limit]
+        return (tuple(ret), complete)
+
+    def _enoughMedia(self, found, pending, limit, order, shares=None):
+        """Returns true once the results found so far can't change the first limit results"""
+        if (order == modulation.query.ORDER_RANDOM):
+            #Every collection has to return its share, however fast the others were
+            if (shares is None or not shares.drawn()):
+                return False
+            for c in pending:
+                if (len(found[c]) < shares.share(c)):
+                    return False
+            return True
+        #Path ordered results are concatenated in collection order
+        count = 0
+        for c in self.__collections:
+            count += len(found[c])
+            if (count >= limit):
+                return True
+            if (c in pending):
+                return False
+        return False
+
+    def _searchCollection(self, c, constraint, limit, order, results, cancel, shares=None):
+        """Runs on the collection's SearchPool, passing its results back to _findMedia()
+
+        If given RandomShares and the collection can count its matches, only
+        its share of the limit is fetched, once every collection is counted.
+        """
+        if (cancel.isSet()):
+            return
+        start = time.time()
+        try:
+            if (not (shares is None) and hasattr(c, 'countMatches')):
+                results.put((c, "count", c.countMatches(constraint)))
+                limit = shares.wait(c)
+                if (limit == 0):
+                    results.put((c, "done", time.time()-start))
+                    return
+            chunk = []
+            count = 0
+            for media in c.iterMedia(constraint, limit, order):
+                if (cancel.isSet()):
+                    break
+                chunk.append(media)
+                count += 1
+                if (count == limit):
+                    #Don't wait for the collection to notice it has given enough
+                    break
+                if (len(chunk) >= self.CHUNK_SIZE):
+                    results.put((c, "media", chunk))
+                    chunk = []
+            results.put((c, "media", chunk))
+            results.put((c, "done", time.time()-start))
+        except Exception, e:
+            results.put((c, "error", e))
+
+    def iterMedia(self, constraint, limit=0, order=modulation.query.ORDER_RANDOM):
+        """Yields up to limit MediaObjects from the collections as they are found"""
+        count = 0
         for c in self.__collections:
-            self._log.debug("Updating %s", c)
             try:
-                c.refresh()
-                ret+=c.findMedia(constraint, limit)
+                for media in c.iterMedia(constraint, limit-count if limit > 0 else 0, order):
+                    yield media
+                    count += 1
             except Exception, e:
                 self._log.error("Exception caught from collection backend %s: %s", c, e)
                 self.send(modulation.ExceptionPacket(self, e))
-            if (len(ret) == limit):
-                return ret
-        return ret
+            if (limit > 0 and count >= limit):
+                return
 
     @modulation.input(modulation.query.QueryPacket)
     def query(self, pkt):
-        """Replies with a QueryResultPacket"""
-        self.send(modulation.query.QueryResultPacket(self, self.findMedia(pkt.constraint, pkt.resultlimit)))
+        """Replies with a QueryResultPacket, or the first page of results for paged queries
+
+        Identical unpaged queries waiting behind pkt are answered along with
+        it, from one search. Random ones are given separate slices of a
+        sample big enough for all of them, as far as the matches go.
+        """
+        if (pkt.pagesize > 0):
+            self._sendPage(uuid.uuid4().hex, QueryCursor(self.iterMedia(pkt.constraint, pkt.resultlimit, pkt.order), pkt.pagesize))
+            return
+        key = modulation.query.canonical(pkt.constraint)
+        packets = [pkt]
+        if (not (key is None)):
+            packets.extend(self._takeQueued(lambda other:isinstance(other, modulation.query.QueryPacket) and
+                other.pagesize == 0 and other.resultlimit == pkt.resultlimit and other.order == pkt.order and
+                modulation.query.canonical(other.constraint) == key))
+        if (len(packets) > 1):
+            self._log.debug("Answering %i identical queries for %r at once", len(packets), pkt.constraint)
+        limit = pkt.resultlimit
+        if (pkt.order == modulation.query.ORDER_RANDOM and limit > 0):
+            found = self.findMedia(pkt.constraint, limit*len(packets), pkt.order)
+            for i in range(len(packets)):
+                share = found[i*limit:(i+1)*limit]
+                if (len(share) < limit and len(found) > len(share)):
+                    share = tuple(random.sample(found, min(limit, len(found))))
+                self.send(modulation.query.QueryResultPacket(self, share))
+        else:
+            found = self.findMedia(pkt.constraint, limit, pkt.order)
+            for packet in packets:
+                if (pkt.order == modulation.query.ORDER_RANDOM):
+                    found = tuple(random.sample(found, len(found)))
+                self.send(modulation.query.QueryResultPacket(self, found))
+
+    @modulation.input(modulation.query.QueryContinuePacket)
+    def continueQuery(self, pkt):
+        """Replies with the next page of a paged query"""
+        cursor = self.__cursors.pop(pkt.token, None)
+        if (isinstance(pkt, modulation.query.QueryCancelPacket)):
+            return
+        if (cursor is None):
+            self._log.warn("Asked to continue unknown or expired query %s", pkt.token)
+            self.send(modulation.query.QueryResultPacket(self, ()))
+        else:
+            self._sendPage(pkt.token, cursor)
+
+    def _sendPage(self, token, cursor):
+        now = time.time()
+        for (oldToken, oldCursor) in self.__cursors.items():
+            if (now - oldCursor.lastUsed > self.CURSOR_TIMEOUT):
+                del self.__cursors[oldToken]
+        (page, more) = cursor.nextPage()
+        if (more):
+            self.__cursors[token] = cursor
+            self.send(modulation.query.QueryResultPacket(self, page, token))
+        else:
+            self.send(modulation.query.QueryResultPacket(self, page))
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright 2010 Trever Fischer <tdfischer@fedoraproject.org>
+#
+# This file is part of modulation.
+#
+# modulation is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# modulation is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with modulation. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Runs DBCache scans in a worker process, away from the streaming threads
+
+Scanning reads and hashes files and parses their tags, all of which holds
+the interpreter lock for long stretches. In its own process it can't stall
+the threads that pace streams, and it runs at a lower priority as well.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import modulation.collection
+import os
+import threading
+from Queue import Empty
+
+_log = logging.getLogger("modulation.indexer")
+
+class IndexerError(Exception):
+    pass
+
+def _indexerMain(path, factory, args, niceness, commands, events):
+    """The worker process: builds the backend, then scans it into path whenever asked"""
+    try:
+        os.nice(niceness)
+    except OSError, e:
+        _log.warn("Could not lower the indexer's priority: %s", e)
+    try:
+        backend = factory(*args)
+        cache = modulation.collection.DBCache(path, backend)
+    except Exception, e:
+        events.put(("failed", None, "%s: %s"%(e.__class__.__name__, e)))
+        return
+    cache.addProgressListener(lambda packet:events.put(("progress", None,
+        (packet.seen, packet.indexed, packet.skipped, packet.total, packet.rate, packet.eta, packet.done))))
+    events.put(("ready", None, None))
+    while True:
+        (command, request) = commands.get()
+        if (command == "stop"):
+            return
+        error = None
+        try:
+            cache.update()
+        except Exception, e:
+            error = "%s: %s"%(e.__class__.__name__, e)
+        events.put(("scanned", request, error))
+
+class ProcessIndexedDBCache(modulation.collection.DBCache):
+    """A DBCache whose scans run in a separate worker process
+
+    factory(*args) is called in the worker to build the backend, such as
+    DirectoryRoot with the library's path, so it has to be picklable. Queries
+    are answered here as usual, while update() asks the worker to scan and
+    waits for it. Once a scan is done, this cache moves on to a new
+    generation, and the worker's ScanProgressPackets are passed on to the
+    progress listeners as they arrive.
+
+    The database is switched to WAL journaling so queries never wait for the
+    worker's writes. If the worker dies, it is started again, and since scans
+    are checkpointed the new one carries on where the last one stopped.
+
+    The worker is forked, so it should be started before the process has
+    many threads of its own.
+    """
+    #How much lower the worker's scheduling priority is
+    NICENESS = 10
+    #Seconds between checks that the worker is still alive while waiting for it
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, path, factory, args=(), niceness=NICENESS):
+        super(ProcessIndexedDBCache, self).__init__(path, None)
+        self.useWriteAheadLog()
+        self.__path = path
+        self.__factory = factory
+        self.__args = args
+        self.__niceness = niceness
+        self.__lock = threading.Lock()
+        self.__pending = {}
+        self.__requests = itertools.count()
+        self.__process = None
+        self.__reader = None
+        self.__start()
+
+    def __start(self):
+        self.__commands = multiprocessing.Queue()
+        self.__events = multiprocessing.Queue()
+        self.__process = multiprocessing.Process(target=_indexerMain, args=(self.__path, self.__factory,
+            self.__args, self.__niceness, self.__commands, self.__events))
+        self.__process.daemon = True
+        self.__process.start()
+        self.__reader = threading.Thread(target=self.__readEvents, args=(self.__process, self.__events))
+        self.__reader.daemon = True
+        self.__reader.start()
+        self._log.info("Started indexer process %i for %s", self.__process.pid, self.__path)
+
+    def __readEvents(self, process, events):
+        while (process.is_alive() or not events.empty()):
+            try:
+                (event, request, value) = events.get(True, self.POLL_INTERVAL)
+            except Empty:
+                continue
+            except (EOFError, IOError), e:
+                break
+            if (event == "progress"):
+                self._dispatchProgress(modulation.collection.ScanProgressPacket(self, *value))
+            elif (event == "scanned"):
+                #The worker may have swept paths whose ids get handed out again
+                self._forgetPaths()
+                self.setLastUpdateTime(self.getMeta('last_update'))
+                self._newGeneration()
+                self.__finish(request, value)
+            elif (event == "failed"):
+                self._log.error("Indexer process could not start: %s", value)
+        self.__failPending(process, "The indexer process exited with code %s"%(process.exitcode,))
+
+    def __finish(self, request, error):
+        with self.__lock:
+            waiter = self.__pending.pop(request, None)
+        if (not (waiter is None)):
+            waiter[1] = error
+            waiter[0].set()
+
+    def __failPending(self, process, error):
+        """Fails the requests that were sent to process, leaving those of any worker that replaced it"""
+        with self.__lock:
+            failed = [request for (request, waiter) in self.__pending.iteritems() if waiter[2] is process]
+            failed = [self.__pending.pop(request) for request in failed]
+        for waiter in failed:
+            waiter[1] = error
+            waiter[0].set()
+
+    def process(self):
+        """Returns the worker's multiprocessing.Process"""
+        return self.__process
+
+    def update(self):
+        """Has the worker scan the backend into the database, and waits until it is done"""
+        self._updateBackend()
+
+    def _updateBackend(self):
+        with self.__lock:
+            if (not self.__process.is_alive()):
+                self._log.warn("Indexer process exited with code %s, restarting it", self.__process.exitcode)
+                self.__start()
+            request = self.__requests.next()
+            waiter = [threading.Event(), None, self.__process]
+            self.__pending[request] = waiter
+            self.__commands.put(("scan", request))
+        waiter[0].wait()
+        if (not (waiter[1] is None)):
+            raise IndexerError, waiter[1]
+
+    def stop(self, timeout=5):
+        """Stops the worker process"""
+        if (self.__process.is_alive()):
+            self.__commands.put(("stop", None))
+            self.__process.join(timeout)
+            if (self.__process.is_alive()):
+                self.__process.terminate()
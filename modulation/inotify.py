@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# Copyright 2010 Trever Fischer <tdfischer@fedoraproject.org>
+#
+# This file is part of modulation.
+#
+# modulation is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# modulation is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with modulation. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Minimal ctypes bindings for the Linux inotify API
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 02000000
+
+_EVENT = struct.Struct("iIII")
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.inotify_init1
+except (OSError, AttributeError):
+    _libc = None
+
+def available():
+    """Returns true if the running system supports inotify"""
+    return _libc is not None
+
+def _check(ret):
+    if (ret < 0):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+class Event(object):
+    """A single event read from an inotify descriptor"""
+    def __init__(self, wd, mask, cookie, name):
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
+        self.name = name
+
+    def isDir(self):
+        return bool(self.mask & IN_ISDIR)
+
+    def __repr__(self):
+        return "Event(%i, 0x%x, %i, %r)"%(self.wd, self.mask, self.cookie, self.name)
+
+class Inotify(object):
+    """An inotify descriptor"""
+    def __init__(self):
+        if (_libc is None):
+            raise OSError("inotify is not available on this system")
+        self.__fd = _check(_libc.inotify_init1(IN_CLOEXEC))
+
+    def fileno(self):
+        return self.__fd
+
+    def addWatch(self, path, mask):
+        """Watches path for the events in mask. Returns the watch descriptor."""
+        return _check(_libc.inotify_add_watch(self.__fd, path, mask))
+
+    def removeWatch(self, wd):
+        """Stops watching the given watch descriptor"""
+        _check(_libc.inotify_rm_watch(self.__fd, wd))
+
+    def read(self, timeout=None):
+        """Returns a list of pending Events, waiting up to timeout seconds for one to arrive"""
+        (readable, writable, errors) = select.select((self.__fd,), (), (), timeout)
+        if (len(readable) == 0):
+            return []
+        buf = os.read(self.__fd, 65536)
+        ret = []
+        offset = 0
+        while (offset < len(buf)):
+            (wd, mask, cookie, length) = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            name = buf[offset:offset+length].rstrip('\0')
+            offset += length
+            ret.append(Event(wd, mask, cookie, name))
+        return ret
+
+    def close(self):
+        os.close(self.__fd)
@@ -21,6 +21,7 @@ from modulation.streaming import FileStream
 import modulation.notifications
 import tagpy
 import modulation.controls
+import os
 import threading
 
 class MediaSource(Plugin):
@@ -156,6 +157,9 @@ class MediaObject(object):
     """A MediaObject represents the a single unit of media.
     It contains two essential atoms of information: the metadata, and the actual data itself.
     """
+    #The path of the leaf this media was found at in a collection, if known
+    collectionPath = None
+
     def getMetadata(self):
         """Returns the metadata"""
         raise NotImplementedError
@@ -167,6 +171,26 @@ class MediaObject(object):
     metadata = property(getMetadata, None, None, "The media's associated metadata")
     stream = property(getStream, None, None, "The media's associated data stream")
 
+#Metadata keys that hold numbers, which are stored and compared numerically
+NUMERIC_METADATA = ("year", "track", "length", "bitrate")
+
+def numericValue(key, value):
+    """Returns a metadata value as a number, or None if it isn't one
+
+    Ints and floats are always numbers. Strings are only parsed for the keys
+    in NUMERIC_METADATA.
+    """
+    if (isinstance(value, bool)):
+        return None
+    if (isinstance(value, (int, long, float))):
+        return value
+    if (key in NUMERIC_METADATA and isinstance(value, basestring)):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
 class Metadata(dict):
     """Metadata is a dictionary of string pairs"""
     pass
@@ -213,25 +237,112 @@ class URLObject(MediaObject):
 
 class FileObject(MediaObject):
     """A MediaObject for a file on a local filesystem"""
-    def __init__(self, file):
+    def __init__(self, file, collectionPath=None):
         MediaObject.__init__(self)
         self.__file = file
+        self.collectionPath = collectionPath
 
     def getStream(self):
         return FileStream(self.__file)
 
     def getMetadata(self):
-        m = Metadata()
+        return metadataCache().get(self.__file)
+
+def readTags(path):
+    """Reads the metadata of a file with taglib"""
+    m = Metadata()
+    try:
+        ref = tagpy.FileRef(path)
+        tags = ref.tag()
+        m["artist"] = tags.artist
+        m["album"] = tags.album
+        m["title"] = tags.title
+        m["year"] = tags.year
+        m["track"] = tags.track
+        properties = ref.audioProperties()
+        if (not (properties is None)):
+            m["length"] = properties.length
+            m["bitrate"] = properties.bitrate
+        return m
+    except ValueError:
+        return EmptyMetadata()
+
+class MetadataCache(object):
+    """Remembers the metadata read from files
+
+    Entries are only used while the file's mtime and size are the same as
+    when it was read. The cache holds up to maxEntries files, or if maxBytes
+    is given, up to roughly that many bytes of metadata. Callers get their own
+    copy of the metadata, so changing it doesn't change the cache.
+    """
+    #Rough per-entry overhead of the dict, key and tuple, in bytes
+    ENTRY_SIZE = 400
+
+    def __init__(self, maxEntries=20000, maxBytes=None):
+        super(MetadataCache, self).__init__()
+        #modulation.util needs this module to be loaded first, so it can't be imported at the top
+        import modulation.util
+        if (maxBytes is None):
+            self.__cache = modulation.util.LRUCache(maxEntries)
+        else:
+            self.__cache = modulation.util.LRUCache(maxBytes, self.__size)
+        self.hits = 0
+        self.misses = 0
+
+    def __size(self, entry):
+        (stamp, metadata) = entry
+        ret = self.ENTRY_SIZE
+        for (key, value) in metadata.iteritems():
+            ret += len(key) + len(unicode(value))
+        return ret
+
+    def get(self, path, read=readTags):
+        """Returns the metadata for path, calling read(path) if it isn't cached"""
         try:
-            ref = tagpy.FileRef(self.__file)
-            tags = ref.tag()
-            m["artist"] = tags.artist
-            m["album"] = tags.album
-            m["title"] = tags.title
-            m["year"] = tags.year
-            return m
-        except ValueError:
-            return EmptyMetadata()
+            st = os.stat(path)
+        except OSError:
+            self.misses += 1
+            return read(path)
+        stamp = (st.st_mtime, st.st_size)
+        entry = self.__cache.get(path)
+        if (entry is None or entry[0] != stamp):
+            self.misses += 1
+            metadata = read(path)
+            self.__cache.put(path, (stamp, metadata))
+        else:
+            self.hits += 1
+            metadata = entry[1]
+        return metadata.__class__(metadata)
+
+    def invalidate(self, path):
+        """Forgets what is cached for path"""
+        self.__cache.discard(path)
+
+    def clear(self):
+        self.__cache.clear()
+
+    def __len__(self):
+        return len(self.__cache)
+
+    def size(self):
+        """Returns the estimated size of the cache in bytes"""
+        return self.__cache.cost()
+
+_metadataCache = None
+_metadataCacheLock = threading.Lock()
+
+def metadataCache():
+    """Returns the process-wide MetadataCache"""
+    global _metadataCache
+    with _metadataCacheLock:
+        if (_metadataCache is None):
+            _metadataCache = MetadataCache()
+        return _metadataCache
+
+def setMetadataCache(cache):
+    """Replaces the process-wide MetadataCache, such as to change its size"""
+    global _metadataCache
+    _metadataCache = cache
 
 class FileSource(MediaSource):
     """A MediaSource that originates from a file on the local filesystem"""
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# Copyright 2010 Trever Fischer <tdfischer@fedoraproject.org>
+#
+# This file is part of modulation.
+#
+# modulation is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# modulation is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with modulation. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An in-memory metadata index for collection trees without a DBCache
+"""
+
+import logging
+import modulation.collection
+import modulation.media
+import modulation.query
+import random
+import threading
+
+_log = logging.getLogger("modulation.metadataindex")
+
+class IndexedMedia(modulation.media.MediaObject):
+    """Stands in for a leaf's media while matching, using the indexed metadata"""
+    def __init__(self, metadata, collectionPath=None):
+        super(IndexedMedia, self).__init__()
+        self.__metadata = metadata
+        self.collectionPath = collectionPath
+
+    def getMetadata(self):
+        return self.__metadata
+
+class MetadataIndex(object):
+    """Remembers the metadata of every leaf beneath a Node
+
+    Besides the metadata itself, every key has an inverted index from each of
+    its values to the paths of the leaves that have it. Constraints on a
+    single key are answered by testing each distinct value once instead of
+    every leaf. When a constraint can't be answered exactly that way, the
+    leaves that are left are checked against the indexed metadata, so media
+    is never opened to answer a query.
+
+    The index follows the node's change notifications, and sync() brings it
+    back in line with the tree after a rescan.
+    """
+    def __init__(self, node):
+        super(MetadataIndex, self).__init__()
+        self.__node = node
+        self.__lock = threading.RLock()
+        self.__leaves = {}
+        self.__values = {}
+        self.__ordered = None
+
+    def __len__(self):
+        return len(self.__leaves)
+
+    def sync(self):
+        """Indexes new leaves and forgets ones that are no longer in the tree"""
+        found = {}
+        stack = [self.__node]
+        while (len(stack) > 0):
+            for child in stack.pop().contents:
+                if (isinstance(child, modulation.collection.Node)):
+                    stack.append(child)
+                else:
+                    found[child.path()] = child
+        with self.__lock:
+            for path in self.__leaves.keys():
+                if (not path in found):
+                    self.__remove(path)
+            stale = [leaf for (path, leaf) in found.iteritems()
+                     if not (path in self.__leaves and self.__leaves[path][0] is leaf)]
+        for leaf in stale:
+            self.add(leaf)
+
+    def add(self, leaf):
+        """Indexes a leaf, replacing what was known about it before"""
+        try:
+            metadata = leaf.media().getMetadata()
+        except Exception, e:
+            _log.warn("Could not read metadata for %s: %s", leaf.path(), e)
+            metadata = modulation.media.EmptyMetadata()
+        metadata = modulation.media.Metadata(metadata)
+        path = leaf.path()
+        with self.__lock:
+            self.__remove(path)
+            self.__leaves[path] = (leaf, metadata)
+            self.__ordered = None
+            for (key, value) in metadata.iteritems():
+                self.__values.setdefault(key, {}).setdefault(value, set()).add(path)
+
+    def remove(self, obj):
+        """Forgets a leaf, or every leaf beneath a node"""
+        with self.__lock:
+            if (isinstance(obj, modulation.collection.Node)):
+                prefix = obj.path().rstrip('/')+'/'
+                for path in [p for p in self.__leaves if p.startswith(prefix)]:
+                    self.__remove(path)
+            else:
+                self.__remove(obj.path())
+
+    def __remove(self, path):
+        if (not path in self.__leaves):
+            return
+        (leaf, metadata) = self.__leaves.pop(path)
+        self.__ordered = None
+        for (key, value) in metadata.iteritems():
+            paths = self.__values[key][value]
+            paths.discard(path)
+            if (len(paths) == 0):
+                del self.__values[key][value]
+                if (len(self.__values[key]) == 0):
+                    del self.__values[key]
+
+    def changed(self, change, obj):
+        """Collection listener that keeps the index in line with the tree"""
+        if (change == modulation.collection.RESCANNED):
+            self.sync()
+        elif (change == modulation.collection.REMOVED):
+            self.remove(obj)
+        elif (isinstance(obj, modulation.collection.Node)):
+            self.remove(obj)
+            stack = [obj]
+            while (len(stack) > 0):
+                for child in stack.pop().contents:
+                    if (isinstance(child, modulation.collection.Node)):
+                        stack.append(child)
+                    else:
+                        self.add(child)
+        else:
+            self.add(obj)
+
+    def candidates(self, constraint):
+        """Returns the paths that may match constraint
+
+        The result is a (paths, exact) tuple. paths is None if any leaf might
+        match, and exact is true if every one of paths is known to match.
+        """
+        if (isinstance(constraint, modulation.query.Any)):
+            return (None, True)
+        if (isinstance(constraint, modulation.query.Nothing)):
+            return (set(), True)
+        if (isinstance(constraint, modulation.query.UnderPath)):
+            prefix = constraint.path().rstrip('/')+'/'
+            return (set([p for p in self.__leaves if p.startswith(prefix)]), True)
+        if (isinstance(constraint, modulation.query.EqualsMetadata)):
+            try:
+                return (set(self.__values.get(constraint.key(), {}).get(constraint.value(), ())), True)
+            except TypeError:
+                return (None, False)
+        if (isinstance(constraint, modulation.query.ContainsMetadata)):
+            ret = set()
+            try:
+                for values in self.__values.itervalues():
+                    ret.update(values.get(constraint.key(), ()))
+            except TypeError:
+                return (None, False)
+            return (ret, True)
+        if (isinstance(constraint, modulation.query.MetadataQuery)):
+            #Everything else only looks at the one key, so each value only needs testing once
+            ret = set()
+            key = constraint.key()
+            for (value, paths) in self.__values.get(key, {}).iteritems():
+                if (constraint.matches(IndexedMedia({key: value}))):
+                    ret.update(paths)
+            return (ret, True)
+        if (isinstance(constraint, modulation.query.Not)):
+            (found, exact) = self.candidates(constraint.constraint())
+            if (not exact):
+                return (None, False)
+            if (found is None):
+                return (set(), True)
+            return (set(self.__leaves).difference(found), True)
+        if (isinstance(constraint, modulation.query.And)):
+            ret = None
+            exact = True
+            for child in constraint.constraints:
+                (found, childExact) = self.candidates(child)
+                exact = exact and childExact
+                if (found is None):
+                    continue
+                if (ret is None):
+                    ret = found
+                else:
+                    ret &= found
+            return (ret, exact)
+        if (isinstance(constraint, modulation.query.Or)):
+            ret = set()
+            exact = True
+            for child in constraint.constraints:
+                (found, childExact) = self.candidates(child)
+                if (found is None):
+                    return (None, False)
+                exact = exact and childExact
+                ret |= found
+            return (ret, exact)
+        return (None, False)
+
+    def __orderedPaths(self):
+        """Returns every indexed path, in the order ORDER_PATH walks the tree"""
+        if (self.__ordered is None):
+            self.__ordered = sorted(self.__leaves, key=lambda x:x.split('/'))
+        return self.__ordered
+
+    def iterMedia(self, constraint, limit=0, order=modulation.query.ORDER_RANDOM):
+        """Returns an iterator over the media of the leaves matching constraint"""
+        with self.__lock:
+            (paths, exact) = self.candidates(constraint)
+            if (order == modulation.query.ORDER_PATH):
+                if (paths is None):
+                    paths = list(self.__orderedPaths())
+                else:
+                    paths = [p for p in self.__orderedPaths() if p in paths]
+            else:
+                if (paths is None):
+                    paths = self.__leaves.keys()
+                else:
+                    paths = list(paths)
+                random.shuffle(paths)
+        return self.__iterMatches(constraint, paths, exact, limit)
+
+    def __iterMatches(self, constraint, paths, exact, limit):
+        count = 0
+        for path in paths:
+            entry = self.__leaves.get(path)
+            if (entry is None):
+                continue
+            (leaf, metadata) = entry
+            if (exact or constraint.matches(IndexedMedia(metadata, path))):
+                yield leaf.media()
+                count += 1
+                if (count == limit):
+                    return
@@ -19,7 +19,19 @@
 import modulation.media
 import re
 import glob
+import fnmatch
 import random
+import unicodedata
+
+#Result orderings understood by findMedia()
+ORDER_RANDOM = "random"
+ORDER_PATH = "path"
+
+def _text(value):
+    """Returns metadata values as strings, the way SQLite compares them to patterns"""
+    if (isinstance(value, basestring)):
+        return value
+    return unicode(value)
 
 class QueryConstraint(object):
     """Base class for query constraints."""
@@ -137,12 +149,32 @@ class EqualsMetadata(MetadataMatch):
     def __repr__(self):
         return "EqualsMetadata(%r, %r)"%(self.key(), self.value())
 
-class GreaterThanMetadata(MetadataMatch):
+class MetadataRange(MetadataMatch):
+    """Base class for comparing the metadata against a value
+
+    When the value is a number, the metadata is compared numerically and only
+    matches if it is a number itself.
+    """
+    def isNumeric(self):
+        """Returns true if the metadata is compared as a number"""
+        return modulation.media.numericValue(None, self.value()) is not None
+
+    def _metadataValue(self, media):
+        """Returns the metadata to compare against, or None if there is nothing to compare"""
+        if (not self.key() in media.getMetadata()):
+            return None
+        value = media.getMetadata()[self.key()]
+        if (self.isNumeric()):
+            return modulation.media.numericValue(self.key(), value)
+        return value
+
+class GreaterThanMetadata(MetadataRange):
     """Matches if the value is greater than the metadata"""
     def matches(self, media):
         super(GreaterThanMetadata, self).matches(media)
-        if (self.key() in media.getMetadata()):
-            return self.value() > media.getMetadata()[self.key()]
+        value = self._metadataValue(media)
+        if (not (value is None)):
+            return self.value() > value
 
     def __repr__(self):
         return "GreaterThanMetadata(%r, %r)"%(self.key(), self.value())
@@ -157,7 +189,7 @@ class MetadataRegex(MetadataMatch):
     def matches(self, media):
         super(MetadataRegex, self).matches(media)
         if (self.key() in media.getMetadata()):
-            return self.value().matches(media.getMetadata()[self.key()])
+            return self.value().match(_text(media.getMetadata()[self.key()])) is not None
         return False
 
 class MetadataGlob(MetadataMatch):
@@ -165,15 +197,16 @@ class MetadataGlob(MetadataMatch):
     def matches(self, media):
         super(MetadataGlob, self).matches(media)
         if (self.key() in media.getMetadata()):
-            return fnmatch.fnmatch(media.getMetadata()[self.key()], self.value())
+            return fnmatch.fnmatchcase(_text(media.getMetadata()[self.key()]), self.value())
         return False
 
-class LessThanMetadata(MetadataMatch):
+class LessThanMetadata(MetadataRange):
     """Matches if the value is less than the metadata"""
     def matches(self, media):
         super(LessThanMetadata, self).matches(media)
-        if (self.key() in media.getMetadata()):
-            return self.value() < media.getMetadata()[self.key()]
+        value = self._metadataValue(media)
+        if (not (value is None)):
+            return self.value() < value
 
     def __repr__(self):
         return "LessThanMetadata(%r, %r)"%(self.key(), self.value())
@@ -182,12 +215,107 @@ class ContainsMetadata(MetadataQuery):
     """Matches if the value is equal to any piece of the metadata"""
     def matches(self, media):
         super(ContainsMetadata, self).matches(media)
-        for data in media.getMetadata():
-            return data == self.key()
+        return self.key() in media.getMetadata().values()
 
     def __repr__(self):
         return "ContainsMetadata(%r)"%(self.key())
 
+def _words(text):
+    """Splits text into lowercase words without accents, like SQLite's unicode61 tokenizer"""
+    if (not isinstance(text, unicode)):
+        text = _text(text)
+        if (not isinstance(text, unicode)):
+            text = text.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = u''.join([c for c in text if not unicodedata.combining(c)])
+    return re.findall(r'[^\W_]+', text, re.UNICODE)
+
+def _hasPhrase(field, words, prefix):
+    """Returns true if words appear consecutively in the list field, the last one only as a prefix if prefix is true"""
+    for start in range(len(field)-len(words)+1):
+        candidate = field[start:start+len(words)]
+        if (candidate[:-1] != list(words[:-1])):
+            continue
+        if (candidate[-1] == words[-1] or (prefix and candidate[-1].startswith(words[-1]))):
+            return True
+    return False
+
+class FullTextMatch(QueryMatchConstraint):
+    """Matches if every word of the search text appears in the artist, album or title
+
+    Words ending with * match any word starting with them, and "quoted phrases"
+    must appear as consecutive words of the same piece of metadata. keys may
+    only name some of KEYS, since those are the ones DBCache indexes.
+    """
+    KEYS = ("artist", "album", "title")
+
+    def __init__(self, text, keys=KEYS):
+        super(FullTextMatch, self).__init__()
+        self.__text = text
+        self.__keys = tuple(keys)
+        if (len(self.__keys) == 0):
+            raise ValueError, "FullTextMatch needs at least one key"
+        for key in self.__keys:
+            if (not key in self.KEYS):
+                raise ValueError, "%r is not one of the full text keys %r"%(key, self.KEYS)
+        terms = ()
+        for match in re.finditer(r'"([^"]*)"(\*?)|(\S+)', text):
+            if (match.group(3) is None):
+                words = _words(match.group(1))
+                prefix = match.group(2) == '*'
+            else:
+                words = _words(match.group(3))
+                prefix = match.group(3).endswith('*')
+            if (len(words) > 0):
+                terms += ((tuple(words), prefix),)
+        self.__terms = terms
+
+    def text(self):
+        return self.__text
+
+    def keys(self):
+        return self.__keys
+
+    def terms(self):
+        """Returns the search terms as a tuple of (words, prefix) pairs"""
+        return self.__terms
+
+    def matches(self, media):
+        super(FullTextMatch, self).matches(media)
+        if (len(self.__terms) == 0):
+            return False
+        metadata = media.getMetadata()
+        fields = [_words(metadata[key]) for key in self.__keys if not metadata.get(key) is None]
+        for (words, prefix) in self.__terms:
+            if (not any([_hasPhrase(field, words, prefix) for field in fields])):
+                return False
+        return True
+
+    def __repr__(self):
+        return "FullTextMatch(%r, %r)"%(self.__text, self.__keys)
+
+class UnderPath(QueryMatchConstraint):
+    """Matches media beneath a path in the collection tree, such as /Jazz/Live
+
+    Only media that knows its collectionPath can match.
+    """
+    def __init__(self, path):
+        super(UnderPath, self).__init__()
+        self.__path = '/'+path.strip('/')
+
+    def path(self):
+        return self.__path
+
+    def matches(self, media):
+        super(UnderPath, self).matches(media)
+        path = media.collectionPath
+        if (path is None):
+            return False
+        return path.startswith(self.__path.rstrip('/')+'/')
+
+    def __repr__(self):
+        return "UnderPath(%r)"%(self.__path)
+
 class QuerySet(QueryMatchConstraint):
     """Base class for compound constraints"""
     def __init__(self, constraints):
@@ -221,18 +349,84 @@ class And(QuerySet):
     def __repr__(self):
         return "And(%r)"%(self.constraints,)
 
+def canonical(constraint):
+    """Returns a hashable key that is equal for constraints that always match the same media
+
+    The children of And and Or are sorted, so their order doesn't matter.
+    Returns None if the constraint's results can't be reused, such as when it
+    contains a RandomMatch.
+    """
+    if (isinstance(constraint, QuerySet)):
+        children = [canonical(c) for c in constraint.constraints]
+        if (None in children):
+            return None
+        return (constraint.__class__.__name__, tuple(sorted(children)))
+    if (isinstance(constraint, Not)):
+        child = canonical(constraint.constraint())
+        if (child is None):
+            return None
+        return (constraint.__class__.__name__, child)
+    if (isinstance(constraint, MetadataRegex)):
+        return (constraint.__class__.__name__, constraint.key(), constraint.value().pattern)
+    if (isinstance(constraint, MetadataMatch)):
+        return (constraint.__class__.__name__, constraint.key(), constraint.value())
+    if (isinstance(constraint, MetadataQuery)):
+        return (constraint.__class__.__name__, constraint.key())
+    if (isinstance(constraint, FullTextMatch)):
+        return (constraint.__class__.__name__, constraint.terms(), tuple(sorted(constraint.keys())))
+    if (isinstance(constraint, UnderPath)):
+        return (constraint.__class__.__name__, constraint.path())
+    if (isinstance(constraint, (Any, Nothing))):
+        return (constraint.__class__.__name__,)
+    return None
+
 class QueryResultPacket(modulation.media.MediaList):
-    """A packet sent in reply to a query. Contains the result list."""
+    """A packet sent in reply to a query. Contains the result list.
+
+    Paged queries are answered one page at a time. Every page but the last
+    carries a token, which is sent back in a QueryContinuePacket to get the
+    next page.
+    """
+    def __init__(self, origin, list, token=None):
+        super(QueryResultPacket, self).__init__(origin, list)
+        self.__token = token
+
+    @property
+    def token(self):
+        """The continuation token, or None if this is the last page"""
+        return self.__token
+
+class QueryContinuePacket(modulation.Packet):
+    """Asks for the next page of a paged query"""
+    def __init__(self, origin, token):
+        super(QueryContinuePacket, self).__init__(origin)
+        self.__token = token
+
+    @property
+    def token(self):
+        return self.__token
+
+class QueryCancelPacket(QueryContinuePacket):
+    """Tells the collection that no more pages of a paged query are wanted"""
     pass
 
 class QueryPacket(modulation.Packet):
-    """Encaspulates a complete query"""
-    def __init__(self, origin, constraint, resultLimit = 0):
+    """Encaspulates a complete query
+
+    order is either ORDER_RANDOM to get results shuffled, or ORDER_PATH to get
+    them in a stable order sorted by path. If pageSize is given, the results
+    are sent pageSize at a time as they are found.
+    """
+    def __init__(self, origin, constraint, resultLimit = 0, order = ORDER_RANDOM, pageSize = 0):
         super(QueryPacket, self).__init__(origin)
         if (not isinstance(constraint, QueryConstraint)):
             raise TypeError, repr(constraint)
+        if (order not in (ORDER_RANDOM, ORDER_PATH)):
+            raise ValueError, repr(order)
         self.__limit = resultLimit
         self.__constraint = constraint
+        self.__order = order
+        self.__pageSize = pageSize
 
     @property
     def resultlimit(self):
@@ -240,4 +434,12 @@ class QueryPacket(modulation.Packet):
 
     @property
     def constraint(self):
-        return self.__constraint
\ No newline at end of file
+        return self.__constraint
+
+    @property
+    def order(self):
+        return self.__order
+
+    @property
+    def pagesize(self):
+        return self.__pageSize
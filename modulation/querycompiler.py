@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Copyright 2010 Trever Fischer <tdfischer@fedoraproject.org>
+#
+# This file is part of modulation.
+#
+# modulation is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# modulation is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with modulation. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compiles query constraint trees into SQL for a DBCache
+"""
+
+import modulation.query
+import threading
+
+class QueryCompiler(object):
+    """Turns a QueryConstraint into a WHERE condition over the entries table
+
+    Every metadata predicate becomes its own subquery on the metadata table,
+    so predicates on different keys can be combined freely. Metadata predicates
+    that sit directly under the same And or Or are merged into one INTERSECT or
+    UNION subquery, which the (name, value, entryid) index answers without
+    touching the table. Numeric range predicates compare against the typed
+    numvalue column instead, making them range scans of the
+    (name, numvalue, entryid) index.
+
+    FullTextMatch uses the database's FTS5 fulltext table if it has one, and
+    falls back to the database's fulltext_term(value, phrase, prefix) function
+    over the metadata table if not, which matches words the same way
+    FullTextMatch.matches() does.
+
+    UnderPath looks its path's descendants up in the path_closure table. The
+    path is bound as the id pathId returns for it, or None if it isn't in
+    the tree.
+
+    The SQL only depends on the shape of the constraint tree; the values are
+    always bound. Compiled SQL is cached per shape.
+    """
+    #How many shapes to remember before starting over
+    CACHE_SIZE = 256
+
+    def __init__(self, fulltext=False, pathId=None):
+        super(QueryCompiler, self).__init__()
+        self.__cache = {}
+        self.__lock = threading.Lock()
+        self.__fulltext = fulltext
+        self.__pathId = pathId
+
+    def fulltext(self):
+        """Returns true if FullTextMatch is compiled against the fulltext table"""
+        return self.__fulltext
+
+    def compile(self, constraint):
+        """Returns a (condition, binds) tuple for constraint"""
+        shape = self.shape(constraint)
+        with self.__lock:
+            sql = self.__cache.get(shape)
+        if (sql is None):
+            sql = self._condition(constraint)
+            with self.__lock:
+                if (len(self.__cache) >= self.CACHE_SIZE):
+                    self.__cache.clear()
+                self.__cache[shape] = sql
+        return (sql, tuple(self._binds(constraint)))
+
+    def shape(self, constraint):
+        """Returns a hashable description of constraint with its values left out"""
+        if (isinstance(constraint, modulation.query.QuerySet)):
+            return (constraint.__class__.__name__,)+tuple([self.shape(c) for c in constraint.constraints])
+        if (isinstance(constraint, modulation.query.Not)):
+            return (constraint.__class__.__name__, self.shape(constraint.constraint()))
+        if (isinstance(constraint, modulation.query.MetadataRange) and constraint.isNumeric()):
+            return (constraint.__class__.__name__, "numeric")
+        if (isinstance(constraint, modulation.query.FullTextMatch)):
+            return (constraint.__class__.__name__, len(constraint.terms()), len(constraint.keys()))
+        return constraint.__class__.__name__
+
+    def _isSet(self, constraint):
+        """Returns true if constraint compiles to a SELECT of matching entry ids"""
+        return isinstance(constraint, (modulation.query.MetadataQuery, modulation.query.FullTextMatch))
+
+    def _partition(self, constraints):
+        """Splits the children of a QuerySet into id selects and other conditions"""
+        sets = [c for c in constraints if self._isSet(c)]
+        others = [c for c in constraints if not self._isSet(c)]
+        return (sets, others)
+
+    def _condition(self, constraint):
+        if (isinstance(constraint, modulation.query.Any)):
+            return "1"
+        if (isinstance(constraint, modulation.query.Nothing)):
+            return "0"
+        if (isinstance(constraint, modulation.query.RandomMatch)):
+            return "(abs(random()) % 101) < ?"
+        if (isinstance(constraint, modulation.query.Not)):
+            return "NOT (%s)"%(self._condition(constraint.constraint()))
+        if (self._isSet(constraint)):
+            return "entries.id IN (%s)"%(self._select(constraint))
+        if (isinstance(constraint, modulation.query.UnderPath) and not (self.__pathId is None)):
+            return "entries.pathid IN (SELECT descendant FROM path_closure WHERE ancestor = ?)"
+        if (isinstance(constraint, modulation.query.And)):
+            return self._combine(constraint.constraints, " INTERSECT ", " AND ", "1")
+        if (isinstance(constraint, modulation.query.Or)):
+            return self._combine(constraint.constraints, " UNION ", " OR ", "0")
+        raise TypeError, repr(constraint)
+
+    def _combine(self, constraints, setOperator, operator, empty):
+        (sets, others) = self._partition(constraints)
+        terms = []
+        if (len(sets) > 0):
+            terms.append("entries.id IN (%s)"%(setOperator.join([self._select(c) for c in sets])))
+        for c in others:
+            terms.append("(%s)"%(self._condition(c)))
+        if (len(terms) == 0):
+            return empty
+        return operator.join(terms)
+
+    def _select(self, constraint):
+        """Returns a SELECT of the ids of entries matching a metadata predicate"""
+        if (isinstance(constraint, modulation.query.EqualsMetadata)):
+            return "SELECT entryid FROM metadata WHERE name = ? AND value = ?"
+        if (isinstance(constraint, modulation.query.HasMetadata)):
+            return "SELECT entryid FROM metadata WHERE name = ?"
+        if (isinstance(constraint, modulation.query.GreaterThanMetadata)):
+            if (constraint.isNumeric()):
+                return "SELECT entryid FROM metadata WHERE name = ? AND numvalue < ?"
+            return "SELECT entryid FROM metadata WHERE name = ? AND value < ?"
+        if (isinstance(constraint, modulation.query.LessThanMetadata)):
+            if (constraint.isNumeric()):
+                return "SELECT entryid FROM metadata WHERE name = ? AND numvalue > ?"
+            return "SELECT entryid FROM metadata WHERE name = ? AND value > ?"
+        if (isinstance(constraint, modulation.query.ContainsMetadata)):
+            return "SELECT entryid FROM metadata WHERE value = ?"
+        if (isinstance(constraint, modulation.query.MetadataRegex)):
+            return "SELECT entryid FROM metadata WHERE name = ? AND value REGEXP ?"
+        if (isinstance(constraint, modulation.query.MetadataGlob)):
+            return "SELECT entryid FROM metadata WHERE name = ? AND value GLOB ?"
+        if (isinstance(constraint, modulation.query.FullTextMatch)):
+            return self._fullTextSelect(constraint)
+        raise TypeError, repr(constraint)
+
+    def _fullTextSelect(self, constraint):
+        if (len(constraint.terms()) == 0):
+            return "SELECT entryid FROM metadata WHERE 0"
+        if (self.__fulltext):
+            return "SELECT rowid FROM fulltext WHERE fulltext MATCH ?"
+        term = "SELECT entryid FROM metadata WHERE name IN (%s) AND fulltext_term(value, ?, ?)"%(','.join('?'*len(constraint.keys())))
+        return "SELECT entryid FROM (%s)"%(' INTERSECT '.join([term]*len(constraint.terms())))
+
+    def _fullTextBinds(self, constraint):
+        if (len(constraint.terms()) == 0):
+            return []
+        if (self.__fulltext):
+            phrases = []
+            for (words, prefix) in constraint.terms():
+                phrases.append('"%s"%s'%(' '.join(words), prefix and '*' or ''))
+            return ["{%s} : (%s)"%(' '.join(constraint.keys()), ' '.join(phrases))]
+        ret = []
+        for (words, prefix) in constraint.terms():
+            ret.extend(constraint.keys())
+            ret.append(' '.join(words))
+            ret.append(int(prefix))
+        return ret
+
+    def _binds(self, constraint):
+        """Returns the bind values for constraint, in the order _condition() uses them"""
+        if (isinstance(constraint, modulation.query.RandomMatch)):
+            return [constraint.chance()]
+        if (isinstance(constraint, modulation.query.Not)):
+            return self._binds(constraint.constraint())
+        if (isinstance(constraint, modulation.query.QuerySet)):
+            (sets, others) = self._partition(constraint.constraints)
+            ret = []
+            for c in sets+others:
+                ret.extend(self._binds(c))
+            return ret
+        if (isinstance(constraint, modulation.query.FullTextMatch)):
+            return self._fullTextBinds(constraint)
+        if (isinstance(constraint, modulation.query.UnderPath)):
+            return [self.__pathId(constraint.path())]
+        if (isinstance(constraint, modulation.query.ContainsMetadata)):
+            return [constraint.key()]
+        if (isinstance(constraint, modulation.query.MetadataRegex)):
+            return [constraint.key(), constraint.value().pattern]
+        if (isinstance(constraint, modulation.query.MetadataMatch)):
+            return [constraint.key(), constraint.value()]
+        if (isinstance(constraint, modulation.query.MetadataQuery)):
+            return [constraint.key()]
+        return []
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+# Copyright 2010 Trever Fischer <tdfischer@fedoraproject.org>
+#
+# This file is part of modulation.
+#
+# modulation is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# modulation is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with modulation. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Collection snapshots, so a restarted process can answer queries before its
+collections have been rebuilt
+
+A snapshot file is a header, one marshalled (path, realpath, metadata) record
+per entry in path order, and a table of record offsets. It is memory-mapped
+when opened, and records are only decoded once a query reaches them.
+"""
+
+import logging
+import marshal
+import mmap
+import modulation.collection
+import modulation.media
+import modulation.metadataindex
+import modulation.query
+import os
+import random
+import struct
+import threading
+
+_log = logging.getLogger("modulation.snapshot")
+
+MAGIC = "MODSNAP\0"
+VERSION = 1
+
+#magic, version, entry count, offset of the record offset table
+_HEADER = struct.Struct("<8sIIQ")
+_OFFSET = struct.Struct("<Q")
+
+class SnapshotError(Exception):
+    pass
+
+def write(path, entries):
+    """Writes a snapshot of (path, realpath, metadata) entries to path
+
+    The entries should be in path order. The snapshot is written next to path
+    and renamed over it once complete, so readers never see half a file.
+    Returns the number of entries written.
+    """
+    tmp = path+".tmp"
+    offsets = []
+    with open(tmp, "wb") as fh:
+        fh.write(_HEADER.pack(MAGIC, VERSION, 0, 0))
+        offset = _HEADER.size
+        for (entryPath, realPath, metadata) in entries:
+            record = marshal.dumps((entryPath, realPath, tuple(metadata.iteritems())))
+            offsets.append(offset)
+            fh.write(record)
+            offset += len(record)
+        offsets.append(offset)
+        fh.write(struct.pack("<%iQ"%(len(offsets)), *offsets))
+        fh.seek(0)
+        fh.write(_HEADER.pack(MAGIC, VERSION, len(offsets)-1, offset))
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(tmp, path)
+    return len(offsets)-1
+
+def nodeEntries(node):
+    """Yields the snapshot entries for every leaf beneath a Node, in path order"""
+    stack = [iter(sorted(node.contents, key=lambda x:x.name()))]
+    while (len(stack) > 0):
+        for child in stack[-1]:
+            if (isinstance(child, modulation.collection.Node)):
+                stack.append(iter(sorted(child.contents, key=lambda x:x.name())))
+                break
+            realPath = None
+            if (isinstance(child, modulation.collection.File)):
+                realPath = child.realPath()
+            yield (child.path(), realPath, child.media().getMetadata())
+        else:
+            stack.pop()
+
+def export(collection, path):
+    """Writes a snapshot of a collection to path and returns the number of entries"""
+    if (isinstance(collection, (modulation.collection.DBCache, modulation.collection.ShardedDBCache))):
+        return write(path, collection.snapshotEntries())
+    return write(path, nodeEntries(collection))
+
+class Snapshot(object):
+    """A memory-mapped snapshot file"""
+    def __init__(self, path):
+        super(Snapshot, self).__init__()
+        with open(path, "rb") as fh:
+            try:
+                self.__map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError), e:
+                raise SnapshotError, "Could not map %s: %s"%(path, e)
+        if (len(self.__map) < _HEADER.size):
+            raise SnapshotError, "%s is too short to be a snapshot"%(path)
+        (magic, version, count, table) = _HEADER.unpack_from(self.__map, 0)
+        if (magic != MAGIC):
+            raise SnapshotError, "%s is not a snapshot"%(path)
+        if (version != VERSION):
+            raise SnapshotError, "%s is a version %i snapshot, expected %i"%(path, version, VERSION)
+        if (table + (count+1)*_OFFSET.size > len(self.__map)):
+            raise SnapshotError, "%s is truncated"%(path)
+        self.__count = count
+        self.__table = table
+        self.__entries = [None]*count
+
+    def __len__(self):
+        return self.__count
+
+    def entry(self, index):
+        """Returns the (path, realpath, metadata) of an entry, decoding it the first time"""
+        ret = self.__entries[index]
+        if (ret is None):
+            (start,) = _OFFSET.unpack_from(self.__map, self.__table + index*_OFFSET.size)
+            (end,) = _OFFSET.unpack_from(self.__map, self.__table + (index+1)*_OFFSET.size)
+            (path, realPath, metadata) = marshal.loads(self.__map[start:end])
+            ret = (path, realPath, modulation.media.Metadata(metadata))
+            self.__entries[index] = ret
+        return ret
+
+    def close(self):
+        self.__map.close()
+
+class SnapshotMedia(modulation.media.MediaObject):
+    """The media for a snapshot entry that wasn't a file, which only has metadata"""
+    def __init__(self, path, metadata):
+        super(SnapshotMedia, self).__init__()
+        self.path = path
+        self.collectionPath = path
+        self.__metadata = metadata
+
+    def getMetadata(self):
+        return modulation.media.Metadata(self.__metadata)
+
+class SnapshotCollection(modulation.collection.Node):
+    """Answers queries from a snapshot until the live collection is ready
+
+    live is a callable that builds the real collection, such as a DBCache over
+    a DirectoryRoot. It is run in the background as soon as the snapshot is
+    open, and every query after it returns is passed on to the collection it
+    built. Until then queries are answered from the snapshot, which is closed
+    once the last query still reading it is done.
+    """
+    def __init__(self, path, live=None):
+        super(SnapshotCollection, self).__init__('', None)
+        self.__lock = threading.Lock()
+        #The live collection once it has taken over, and the Snapshot until then
+        self.__state = (None, Snapshot(path))
+        #Queries still reading the snapshot, which is only closed once they are done
+        self.__readers = 0
+        self.__loader = None
+        if (not (live is None)):
+            self.__loader = threading.Thread(target=self.__load, args=(live,))
+            self.__loader.daemon = True
+            self.__loader.start()
+
+    def __load(self, live):
+        try:
+            collection = live()
+        except Exception, e:
+            _log.error("Could not load the live collection, staying on the snapshot: %s", e)
+            return
+        with self.__lock:
+            snapshot = self.__state[1]
+            self.__state = (collection, None)
+            if (self.__readers == 0):
+                snapshot.close()
+        self._notify(modulation.collection.RESCANNED, self)
+        _log.info("Handed over to %r", collection)
+
+    def __acquire(self):
+        """Returns the live collection and snapshot, counting a reader if it is the snapshot"""
+        with self.__lock:
+            (live, snapshot) = self.__state
+            if (live is None):
+                self.__readers += 1
+            return (live, snapshot)
+
+    def __release(self, snapshot):
+        with self.__lock:
+            self.__readers -= 1
+            if (self.__readers == 0 and not (self.__state[1] is snapshot)):
+                snapshot.close()
+
+    def live(self):
+        """Returns the live collection, or None while the snapshot is still in use"""
+        return self.__state[0]
+
+    def waitForLive(self, timeout=None):
+        """Waits for the live collection to take over, and returns it"""
+        if (not (self.__loader is None)):
+            self.__loader.join(timeout)
+        return self.live()
+
+    def generation(self):
+        ret = super(SnapshotCollection, self).generation()
+        live = self.live()
+        if (not (live is None)):
+            ret += live.generation()
+        return ret
+
+    def lastUpdateTime(self):
+        live = self.live()
+        if (not (live is None)):
+            return live.lastUpdateTime()
+        return super(SnapshotCollection, self).lastUpdateTime()
+
+    def refresh(self):
+        live = self.live()
+        if (not (live is None)):
+            live.refresh()
+
+    def revalidate(self):
+        live = self.live()
+        if (not (live is None)):
+            live.revalidate()
+
+    def update(self):
+        live = self.live()
+        if (not (live is None)):
+            live.update()
+
+    def findMedia(self, constraint, limit=0, order=modulation.query.ORDER_RANDOM):
+        return tuple(self.iterMedia(constraint, limit, order))
+
+    def iterMedia(self, constraint, limit=0, order=modulation.query.ORDER_RANDOM):
+        live = self.live()
+        if (not (live is None)):
+            return live.iterMedia(constraint, limit, order)
+        return self.__iterSnapshot(constraint, limit, order)
+
+    def __iterSnapshot(self, constraint, limit, order):
+        #The live collection may have taken over since iterMedia() looked
+        (live, snapshot) = self.__acquire()
+        if (not (live is None)):
+            for media in live.iterMedia(constraint, limit, order):
+                yield media
+            return
+        try:
+            if (order == modulation.query.ORDER_PATH):
+                indexes = xrange(len(snapshot))
+            elif (limit > 0):
+                indexes = self.__sample(snapshot, constraint, limit)
+            else:
+                indexes = range(len(snapshot))
+                random.shuffle(indexes)
+            for media in self.__iterMatches(snapshot, constraint, indexes, limit):
+                yield media
+        finally:
+            self.__release(snapshot)
+
+    def __sample(self, snapshot, constraint, limit):
+        """Returns up to limit random indexes of matching entries
+
+        Entries are drawn at random until enough match, so only as many are
+        decoded as it takes to find them. Once half of the snapshot has been
+        tried, the rest is gone through in a random order instead.
+        """
+        count = len(snapshot)
+        found = []
+        seen = set()
+        while (len(found) < limit and len(seen) < count // 2):
+            index = random.randrange(count)
+            if (index in seen):
+                continue
+            seen.add(index)
+            if (self.__matches(snapshot, constraint, index)):
+                found.append(index)
+        if (len(found) < limit):
+            remaining = [i for i in xrange(count) if not i in seen]
+            random.shuffle(remaining)
+            for index in remaining:
+                if (self.__matches(snapshot, constraint, index)):
+                    found.append(index)
+                    if (len(found) == limit):
+                        break
+        return found
+
+    def __matches(self, snapshot, constraint, index):
+        (path, realPath, metadata) = snapshot.entry(index)
+        return constraint.matches(modulation.metadataindex.IndexedMedia(metadata, path))
+
+    def __iterMatches(self, snapshot, constraint, indexes, limit):
+        count = 0
+        for index in indexes:
+            if (self.__matches(snapshot, constraint, index)):
+                (path, realPath, metadata) = snapshot.entry(index)
+                if (realPath is None):
+                    yield SnapshotMedia(path, metadata)
+                else:
+                    yield modulation.media.FileObject(realPath, path)
+                count += 1
+                if (count == limit):
+                    return
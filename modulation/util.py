@@ -20,8 +20,21 @@ import modulation
 from modulation import Plugin, ExceptionPacket, KillAllPacket
 from modulation.controls import Enqueue, Next
 from modulation.notifications import PlaybackComplete
+import logging
 import threading
 import sqlite3
+import os
+import stat
+import collections
+import hashlib
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 class ExceptionHandler(Plugin):
     def __init__(self):
@@ -89,29 +102,263 @@ class PacketFilter(Plugin):
         if (isinstance(pkt, self.__type)):
             self.send(pkt)
 
+class _BatchConnection(sqlite3.Connection):
+    """A connection whose commits are held back while it carries a batch"""
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.batching = False
+
+    def commit(self):
+        if (not self.batching):
+            sqlite3.Connection.commit(self)
+
+    def flush(self):
+        """Commits the batch so far"""
+        sqlite3.Connection.commit(self)
+
+class _SqliteBatch(object):
+    def __init__(self, db):
+        self.__db = db
+
+    def __enter__(self):
+        self.__db.beginBatch()
+
+    def __exit__(self, type, value, traceback):
+        self.__db.endBatch(type is None)
+
 class ThreadingSqliteDB(object):
+    """Hands out sqlite connections to one thread at a time
+
+    Each with block gets a new connection, except inside batch(): then every
+    with block of the batching thread shares one connection, and its commits
+    are held back until commitBatch() or the end of the batch. A batching
+    thread doesn't wait for the others, and the others keep getting
+    connections of their own, so they only ever see what a batch has
+    committed. Their writes wait for the batch's next commit.
+    """
+    #Seconds a connection waits for another one's transaction before giving up
+    BUSY_TIMEOUT = 60
+
     def __init__(self, dbpath):
         self.__path = dbpath
         self.__lock = threading.Lock()
         self.__owner = None
         self.__lockDepth = 0
+        self.__functions = []
+        self.__local = threading.local()
+
+    def createFunction(self, name, nargs, func):
+        """Registers a SQL function on every connection made to the database"""
+        self.__functions.append((name, nargs, func))
+
+    def __connect(self):
+        db = sqlite3.connect(self.__path, timeout=self.BUSY_TIMEOUT, factory=_BatchConnection)
+        db.row_factory = sqlite3.Row
+        db.text_factory = str
+        for (name, nargs, func) in self.__functions:
+            db.create_function(name, nargs, func)
+        return db
+
+    def __batch(self):
+        return getattr(self.__local, 'batch', None)
 
     def __enter__(self):
+        if (not (self.__batch() is None)):
+            #Nothing else writes through this connection, so there is nothing to wait for
+            return self.__batch()
         if (self.__owner != threading.current_thread()):
             self.__lock.acquire()
             self.__owner = threading.current_thread()
         self.__lockDepth+=1
-        db = sqlite3.connect(self.__path)
-        db.row_factory = sqlite3.Row
-        db.text_factory = str
-        return db
+        return self.__connect()
 
     def __exit__(self, type, value, traceback):
+        if (not (self.__batch() is None)):
+            return
         self.__lockDepth-=1
         if (self.__lockDepth == 0):
             self.__lock.release()
             self.__owner = None
 
+    def batch(self):
+        """Returns a context manager that batches this thread's writes into one transaction
+
+        When the with block ends the batch is committed, or if it raised,
+        whatever it wrote since the last commitBatch() is rolled back.
+        """
+        return _SqliteBatch(self)
+
+    def beginBatch(self):
+        if (self.__batch() is None):
+            self.__local.batch = self.__connect()
+            self.__local.batch.batching = True
+            self.__local.depth = 0
+        self.__local.depth += 1
+
+    def commitBatch(self):
+        """Commits what this thread's batch has written so far"""
+        if (not (self.__batch() is None)):
+            self.__batch().flush()
+
+    def endBatch(self, commit=True):
+        batch = self.__batch()
+        self.__local.depth -= 1
+        if (self.__local.depth == 0):
+            self.__local.batch = None
+            if (commit):
+                batch.flush()
+            else:
+                batch.rollback()
+            batch.close()
+
+class LRUCache(object):
+    """A thread safe mapping that forgets the least recently used items once it is full
+
+    Each item has a cost, given by the cost function (one per item by default).
+    Once the total cost goes over maxCost, the least recently used items are
+    dropped until it fits again. If given, evicted(key, value) is called for
+    each dropped item, after the cache has been unlocked again.
+    """
+    def __init__(self, maxCost, cost=None, evicted=None):
+        self.__items = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.__maxCost = maxCost
+        self.__cost = cost
+        self.__evicted = evicted
+        self.__total = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __itemCost(self, value):
+        if (self.__cost is None):
+            return 1
+        return self.__cost(value)
+
+    def get(self, key, default=None):
+        """Returns the value stored for key, or default"""
+        with self.__lock:
+            try:
+                (value, cost) = self.__items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.__items[key] = (value, cost)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Stores value under key, unless it costs more than the whole cache"""
+        cost = self.__itemCost(value)
+        dropped = []
+        with self.__lock:
+            if (key in self.__items):
+                self.__total -= self.__items.pop(key)[1]
+            if (cost > self.__maxCost):
+                return
+            self.__items[key] = (value, cost)
+            self.__total += cost
+            while (self.__total > self.__maxCost):
+                (oldKey, (oldValue, oldCost)) = self.__items.popitem(False)
+                self.__total -= oldCost
+                dropped.append((oldKey, oldValue))
+        if (not (self.__evicted is None)):
+            for (oldKey, oldValue) in dropped:
+                self.__evicted(oldKey, oldValue)
+
+    def discard(self, key):
+        """Forgets key, if it is stored"""
+        with self.__lock:
+            if (key in self.__items):
+                self.__total -= self.__items.pop(key)[1]
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
+            self.__total = 0
+
+    def cost(self):
+        """Returns the total cost of everything stored"""
+        return self.__total
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __contains__(self, key):
+        return key in self.__items
+
+#How much of each end of a file contentId() reads
+CONTENT_BLOCK = 65536
+
+def contentId(path, size=None):
+    """Returns a cheap identifier for a file's contents
+
+    It is made from the file's size and a hash of its first and last
+    CONTENT_BLOCK bytes, which is where tags live, so it stays the same when
+    the file is moved or renamed but changes when it is retagged. Empty files
+    have nothing to tell them apart, so they get None.
+    """
+    with open(path, "rb") as fh:
+        if (size is None):
+            size = os.fstat(fh.fileno()).st_size
+        if (size == 0):
+            return None
+        digest = hashlib.sha1(fh.read(CONTENT_BLOCK))
+        if (size > CONTENT_BLOCK):
+            fh.seek(max(size - CONTENT_BLOCK, CONTENT_BLOCK))
+            digest.update(fh.read(CONTENT_BLOCK))
+    return "%x:%s"%(size, digest.hexdigest())
+
+class _DirEntry(object):
+    """Stand-in for os.DirEntry when neither os.scandir nor the scandir module is available
+
+    Like os.DirEntry, nothing is stat()ed until it is asked for, so an entry
+    that vanishes while its directory is listed only fails on its own.
+    """
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = directory+"/"+name
+        self.__lstat = None
+        self.__stat = None
+
+    def __lstatResult(self):
+        if (self.__lstat is None):
+            self.__lstat = os.lstat(self.path)
+        return self.__lstat
+
+    def is_symlink(self):
+        try:
+            return stat.S_ISLNK(self.__lstatResult().st_mode)
+        except OSError, e:
+            return False
+
+    def stat(self, follow_symlinks=True):
+        if (not follow_symlinks or not self.is_symlink()):
+            return self.__lstatResult()
+        if (self.__stat is None):
+            self.__stat = os.stat(self.path)
+        return self.__stat
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError, e:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError, e:
+            return False
+
+    def inode(self):
+        return self.__lstatResult().st_ino
+
+def scanDirectory(path):
+    """Returns an iterator of DirEntry objects for path, caching each entry's type"""
+    if (scandir is None):
+        return (_DirEntry(path, name) for name in os.listdir(path))
+    return scandir(path)
+
 class EndNodeException(Exception):
     pass
 
@@ -156,9 +403,14 @@ class File:
     
     def getPUID(self):
         if self.__puid is None:
+            length = self.metadata.get("length")
+            if not length:
+                #musicdns can't match a fingerprint without the track's length
+                self.__log.warn("Not requesting a PUID for %s, its length is unknown", self.path)
+                return None
             self.__log.debug("Requesting PUID")
             fingerprint = self.fingerprint
-            time = self.properties.length*1000
+            time = length*1000
             self.__puid = musicdns.lookup_fingerprint(fingerprint, time, MUSICDNS_KEY)
             self.__log.debug("Got PUID")
         return self.__puid
@@ -173,8 +425,13 @@ class File:
             self.__tags = self.__getTagRef().tag()
         return self.__tags
 
+    def getMetadata(self):
+        """Returns the file's metadata, through the process-wide MetadataCache"""
+        return modulation.media.metadataCache().get(self.path)
+
     def writeTags(self):
         self.__getTagRef().save()
+        modulation.media.metadataCache().invalidate(self.path)
 
     def __getTagRef(self):
         if self.__tagref is None:
@@ -191,6 +448,7 @@ class File:
     fingerprint = property(getFingerprint, None, None, "The file's musicdns fingerprint")
     puid = property(getPUID, None, None, "The file's musicdns PUID")
     tags = property(getTags, None, None, "The tags found in the file")
+    metadata = property(getMetadata, None, None, "The file's metadata, as a FileObject would report it")
     
     def __str__(self):
         return self.path